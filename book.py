@@ -0,0 +1,121 @@
+from argparse import ArgumentParser
+from random import choice, random
+from time import perf_counter
+
+from player import BOOK_PATH, OpeningBook, Player, State
+from runner import update_players
+
+
+def play_game(
+    book: OpeningBook,
+    book_plies: int,
+    book_budget: float,
+    game_plies: int,
+    game_budget: float,
+    randomness: float,
+) -> State:
+    """
+    Play a self-play game, adding deeply searched opening moves to the book.
+
+    The first `book_plies` plies are searched for `book_budget` seconds each,
+    the rest of the game is played faster, only to find its result. Moves of
+    the player who lost the game don't get to the book. With probability
+    `randomness`, a random move is played instead of the book one, so that
+    the games cover different openings.
+
+    Returns the result from the POV of the first player.
+    """
+    board_size = 13
+    small_figures = {"q": 1, "a": 2, "b": 2, "s": 2, "g": 2}
+    big_figures = {figure.upper(): val for figure, val in small_figures.items()}
+
+    players = (
+        Player("book1", False, board_size, small_figures, big_figures),
+        Player("book2", True, board_size, big_figures, small_figures),
+    )
+    openings = (OpeningBook(), OpeningBook())
+
+    state = State.RUNNING
+
+    for ply in range(game_plies):
+        index = ply % 2
+        active = players[index]
+        passive = players[1 - index]
+
+        active.load_board()
+        active.table.new_search()
+
+        state = active.game_state(players[0].upper)
+
+        if state.is_end():
+            break
+
+        if active.myMove == 0:
+            # the first placement is the same as in the game, random for the second
+            active.tournament = True
+            move = active.move()
+        else:
+            moves = list(active.valid_moves)
+
+            if not moves:
+                move = []
+            else:
+                budget = book_budget if ply < book_plies else game_budget
+                start = perf_counter()
+                result, _ = active.minimax(moves, start + budget)
+
+                if ply < book_plies:
+                    openings[index].add(active, result.move, result.depth)
+                    print(
+                        f"Ply {ply}: {result.move} at depth {result.depth}",
+                        f"in {perf_counter() - start:.1f} s",
+                    )
+
+                played = choice(moves) if random() < randomness else result.move
+                move = played.to_brute(active.upper)
+
+        update_players(move, active, passive)
+
+        if index == 1:
+            players[0].myMove += 1
+            players[1].myMove += 1
+
+    if state != State.LOSS:
+        book.merge(openings[0])
+
+    if state != State.WIN:
+        book.merge(openings[1])
+
+    return state
+
+
+def build_book() -> None:
+    """Extend the opening book by playing self-play games."""
+    parser = ArgumentParser(description=build_book.__doc__)
+    parser.add_argument("--games", type=int, default=10)
+    parser.add_argument("--book-plies", type=int, default=8)
+    parser.add_argument("--book-budget", type=float, default=20)
+    parser.add_argument("--game-plies", type=int, default=80)
+    parser.add_argument("--game-budget", type=float, default=1)
+    parser.add_argument("--randomness", type=float, default=0.2)
+    parser.add_argument("--output", default=str(BOOK_PATH))
+    args = parser.parse_args()
+
+    book = OpeningBook.read(args.output)
+
+    for game in range(args.games):
+        state = play_game(
+            book,
+            args.book_plies,
+            args.book_budget,
+            args.game_plies,
+            args.game_budget,
+            args.randomness,
+        )
+        print(f"Game {game}: {state.name}, {len(book)} positions in the book")
+
+        book.write(args.output)
+
+
+if __name__ == "__main__":
+    build_book()
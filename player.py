@@ -1,13 +1,20 @@
 from __future__ import annotations
 
 import functools
+import math
+import pathlib
+import signal
+import threading
 import time
+from array import array
 from collections import deque
-from contextlib import contextmanager
+from contextlib import ExitStack, contextmanager
 from dataclasses import dataclass
 from enum import Enum, IntEnum
-from itertools import chain, count, islice, product
-from random import choice
+from itertools import chain, product
+from multiprocessing.pool import AsyncResult, Pool
+from multiprocessing.sharedctypes import RawArray
+from random import Random
 from typing import Any, Iterator
 
 from base import Board
@@ -29,6 +36,9 @@ type MoveBrute = list[Any]
 
 DIRECTIONS = [(1, 0), (0, 1), (-1, 1), (-1, 0), (0, -1), (1, -1)]
 
+DIRECTION_INDEX = {direction: index for index, direction in enumerate(DIRECTIONS)}
+"""Index of every direction in `DIRECTIONS`, the neighbors of a direction are ±1"""
+
 
 def length_of_iter[T](iterator: Iterator[T]) -> int:
     """Count the number of elements in an iterator."""
@@ -54,13 +64,27 @@ def convert_board(board: BoardDataBrute) -> BoardData:
     Utilizes lists instead of strings for faster manipulations.
     """
     return {
-        (p, q): list(map(Piece.from_str, value))
+        (p, q): [PIECE_CHARS[char] for char in value]
         for p, row in board.items()
         for q, value in row.items()
         if value
     }
 
 
+def play_brute_move(board: BoardDataBrute, move: MoveBrute) -> BoardDataBrute:
+    """Return a copy of the board in brute representation with the move played."""
+    piece, p, q, new_p, new_q = move
+
+    board = {column: row.copy() for column, row in board.items()}
+
+    if p is not None:
+        board[p][q] = board[p][q][:-1]
+
+    board[new_p][new_q] += piece
+
+    return board
+
+
 def rotate_left(direction: Direction) -> Direction:
     """Return direction rotated one tile to left."""
     p, q = direction
@@ -179,7 +203,7 @@ def evaluate_cell(
     score += blocking_score * 2 if piece_kind == PieceKind.Ant else 1
 
     if rivals_queen:
-        score -= 20 * player.distance(*cell, *rivals_queen)
+        score -= 20 * player.tables.distance(cell, rivals_queen)
 
     if piece_kind == PieceKind.Beetle and len(pieces) > 1:
         score += calculate_beetle_blocking_score(
@@ -211,8 +235,6 @@ evaluated = 0
 updates = 0
 cache_hits = 0
 
-found_cycles = 0
-duplicates = 0
 removed = 0
 
 
@@ -224,20 +246,13 @@ def evaluate_position(player: Player, *, target_player: bool) -> tuple[int, Stat
 
     score = 0
 
-    rivals_queen_str = (
-        PieceKind.Queen.lower() if target_player else PieceKind.Queen.upper()
-    )
-
-    rivals_queen = next(
-        (c for c, p in player._board.items() if rivals_queen_str in p),
-        None,
-    )
+    rivals_queen = player.queen_cells[not target_player]
 
     for cell, pieces in player._board.items():
         is_target_cell = player.is_target_cell(cell, target_player)
 
         if is_target_cell and rivals_queen:
-            score -= player.distance(*cell, *rivals_queen)
+            score -= player.tables.distance(cell, rivals_queen)
 
         piece_score, game_state = evaluate_cell(
             player,
@@ -279,23 +294,290 @@ class PieceKind(str, Enum):
         return self.value.lower()
 
 
-@dataclass
+KIND_INDEX = {kind: index for index, kind in enumerate(PieceKind)}
+"""Index of every piece kind, used to index the Zobrist keys"""
+
+KINDS = list(KIND_INDEX)
+"""Piece kinds by their index, inverse of `KIND_INDEX`"""
+
+
 class Piece:
-    """Game piece."""
+    """
+    Game piece.
 
-    __slots__ = ("kind", "upper")
+    There are only ten distinct pieces, which are interned in `PIECES` and
+    `PIECE_CHARS`, so the board and the moves never allocate new ones.
+    """
+
+    __slots__ = ("kind", "upper", "index", "char")
 
     kind: PieceKind
     upper: bool
+    index: int
+    """Small integer with the kind in the high bits and the color in the lowest one"""
+    char: str
+    """Character of the piece in the brute representation"""
+
+    def __init__(self, kind: PieceKind, upper: bool) -> None:
+        """Create a piece, prefer the interned ones from `PIECES`."""
+        self.kind = kind
+        self.upper = upper
+        self.index = KIND_INDEX[kind] << 1 | upper
+        self.char = kind.upper() if upper else kind.lower()
 
     @staticmethod
     def from_str(string: str) -> Piece:
         """Convert a string to a `Piece`."""
-        return Piece(PieceKind.from_str(string), string.isupper())
+        return PIECE_CHARS[string]
+
+    def __eq__(self, other: object) -> bool:
+        """Compare the pieces by value, which is mostly by identity."""
+        return self is other or (isinstance(other, Piece) and self.index == other.index)
+
+    def __hash__(self) -> int:
+        """Return the index as the hash."""
+        return self.index
 
     def __str__(self) -> str:
         """Return the string representation of the piece."""
-        return self.kind.upper() if self.upper else self.kind.lower()
+        return self.char
+
+    def __repr__(self) -> str:
+        """Return the debug representation of the piece."""
+        return f"Piece({self.char!r})"
+
+
+PIECES = {kind: (Piece(kind, False), Piece(kind, True)) for kind in PieceKind}
+"""Interned lower and upper piece of every kind"""
+
+PIECE_CHARS = {piece.char: piece for pair in PIECES.values() for piece in pair}
+"""Interned pieces by their brute character"""
+
+PIECE_COUNT = len(PIECE_CHARS)
+"""Number of distinct pieces, the upper bound of `Piece.index`"""
+
+MAX_HEIGHT = 6
+"""Maximum height of a stack of pieces (four beetles on top of a piece + margin)"""
+
+ZOBRIST_SEED = 0x1DE5
+
+
+def board_cells(size: int) -> Iterator[Cell]:
+    """Return an iterator over all cells of a board with the given size."""
+    return ((p, q) for q in range(size) for p in range(-(q // 2), size - q // 2))
+
+
+class BoardTables:
+    """
+    Lookup tables of the geometry of a board of a single size.
+
+    The cells are indexed densely in the order of `board_cells`. Neighbors are
+    stored in slots of six per cell, in the order of `DIRECTIONS`, with -1 for
+    the ones outside of the board.
+    """
+
+    __slots__ = (
+        "cells",
+        "cell_index",
+        "neighbor_indices",
+        "neighbor_cells",
+        "distances",
+    )
+
+    cells: list[Cell]
+    cell_index: dict[Cell, int]
+    neighbor_indices: list[int]
+    """Neighbor of the cell `i` in the direction `d` at `6 * i + d`, -1 if off-board"""
+    neighbor_cells: dict[Cell, tuple[Cell, ...]]
+    """Neighbors of the cell inside of the board"""
+    distances: list[list[int]]
+    """Hex distances between all pairs of the cells, indexed by the cell indices"""
+
+    def __init__(self, size: int) -> None:
+        """Build the tables for a board of the given size."""
+        self.cells = list(board_cells(size))
+        self.cell_index = {cell: index for index, cell in enumerate(self.cells)}
+
+        self.neighbor_indices = [
+            self.cell_index.get((p + dp, q + dq), -1)
+            for p, q in self.cells
+            for dp, dq in DIRECTIONS
+        ]
+
+        self.neighbor_cells = {
+            cell: tuple(
+                self.cells[neighbor]
+                for neighbor in self.neighbor_indices[6 * index : 6 * index + 6]
+                if neighbor >= 0
+            )
+            for index, cell in enumerate(self.cells)
+        }
+
+        self.distances = [
+            [
+                (abs(p - op) + abs(q - oq) + abs(p + q - op - oq)) // 2
+                for op, oq in self.cells
+            ]
+            for p, q in self.cells
+        ]
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def for_size(size: int) -> BoardTables:
+        """Return the tables for the given board size, shared by all players."""
+        return BoardTables(size)
+
+    def distance(self, first: Cell, second: Cell) -> int:
+        """Return the hex distance between the cells."""
+        index = self.cell_index
+        return self.distances[index[first]][index[second]]
+
+
+class ZobristKeys:
+    """
+    Random keys for Zobrist hashing of the positions.
+
+    The key of a position is XOR of the keys of all the pieces on the board
+    (indexed by cell, piece kind, color and height in the stack) and of the side
+    key, when the upper player is to move. So the keys are the same for both
+    players and across their moves.
+    """
+
+    __slots__ = ("pieces", "side")
+
+    pieces: dict[Cell, list[int]]
+    side: int
+
+    def __init__(self, size: int) -> None:
+        """Generate the keys for a board of the given size."""
+        rng = Random(ZOBRIST_SEED)
+
+        def key() -> int:
+            return rng.getrandbits(64)
+
+        cells = list(board_cells(size))
+        per_cell = 2 * len(KIND_INDEX) * MAX_HEIGHT
+
+        self.pieces = {cell: [key() for _ in range(per_cell)] for cell in cells}
+        self.side = key()
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def for_size(size: int) -> ZobristKeys:
+        """Return the keys for the given board size, shared by all players."""
+        return ZobristKeys(size)
+
+    def piece(self, cell: Cell, piece: Piece, height: int) -> int:
+        """Return the key of the piece at the given height in the given cell."""
+        index = piece.index * MAX_HEIGHT + height
+        return self.pieces[cell][index]
+
+
+def count_neighbor_groups(ring: int) -> int:
+    """
+    Return the number of groups of the occupied neighbors of a cell.
+
+    `ring` has a bit set for every occupied neighbor, in the order of `DIRECTIONS`.
+    """
+    occupied = [bool(ring >> index & 1) for index in range(len(DIRECTIONS))]
+
+    groups = 0
+    in_group = occupied[0]
+
+    for neighbor in occupied[1:]:
+        if neighbor:
+            in_group = True
+        elif in_group:
+            in_group = False
+            groups += 1
+
+    if in_group and not occupied[0]:
+        groups += 1
+
+    return groups
+
+
+NEIGHBOR_GROUPS = [count_neighbor_groups(ring) for ring in range(1 << len(DIRECTIONS))]
+"""Number of the groups of neighbors for every ring of occupied neighbors"""
+
+
+class BitboardLayout:
+    """
+    Maps the cells of a board to the bits of integers used as bitboards.
+
+    Every `q` coordinate is a row of the bitboard, with an empty row below the
+    board and an empty column at the end of every row, so shifting a bitboard
+    by the offset of a direction never moves a cell onto another valid cell and
+    the neighbors of any cell have a non-negative index.
+    """
+
+    __slots__ = ("cell_masks", "bit_cells", "board", "shifts", "neighbor_masks")
+
+    cell_masks: dict[Cell, int]
+    """Bitboard with only the given cell"""
+    bit_cells: list[Cell | None]
+    """Cell of every bit index, `None` for the padding"""
+    board: int
+    """Bitboard of all the cells of the board"""
+    shifts: list[int]
+    """Offsets of the bit index in every direction, in the order of `DIRECTIONS`"""
+    neighbor_masks: dict[Cell, int]
+    """Bitboard of the neighbors of the given cell"""
+
+    def __init__(self, size: int) -> None:
+        """Lay out the cells of a board of the given size."""
+        width = size + size // 2 + 1
+        cells = list(board_cells(size))
+
+        self.bit_cells = [None] * (width * (size + 2))
+        self.cell_masks = {}
+
+        for p, q in cells:
+            index = (q + 1) * width + p + size // 2
+            self.bit_cells[index] = (p, q)
+            self.cell_masks[p, q] = 1 << index
+
+        self.board = sum(self.cell_masks.values())
+        self.shifts = [dq * width + dp for dp, dq in DIRECTIONS]
+        self.neighbor_masks = {
+            cell: self.neighbors(mask) for cell, mask in self.cell_masks.items()
+        }
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def for_size(size: int) -> BitboardLayout:
+        """Return the layout for the given board size, shared by all players."""
+        return BitboardLayout(size)
+
+    def neighbors(self, bitboard: int) -> int:
+        """Return the bitboard of all the neighbors of the cells of the bitboard."""
+        result = 0
+
+        for shift in self.shifts:
+            result |= bitboard << shift if shift > 0 else bitboard >> -shift
+
+        return result & self.board
+
+    def cells(self, bitboard: int) -> Iterator[Cell]:
+        """Return an iterator over the cells of the bitboard."""
+        bit_cells = self.bit_cells
+
+        while bitboard:
+            lowest = bitboard & -bitboard
+            cell = bit_cells[lowest.bit_length() - 1]
+            assert cell is not None
+            yield cell
+            bitboard ^= lowest
+
+    def ring(self, bitboard: int, cell: Cell) -> int:
+        """Return which neighbors of the cell are in the bitboard, bit per direction."""
+        index = self.cell_masks[cell].bit_length() - 1
+        ring = 0
+
+        for direction, shift in enumerate(self.shifts):
+            ring |= (bitboard >> index + shift & 1) << direction
+
+        return ring
 
 
 @dataclass
@@ -312,6 +594,13 @@ class Move:
     start: Cell | None
     end: Cell
 
+    @staticmethod
+    def from_brute(brute: MoveBrute) -> Move:
+        """Convert the move from brute representation."""
+        piece, p, q, np, nq = brute
+        start = None if p is None else (p, q)
+        return Move(PieceKind.from_str(piece), start, (np, nq))
+
     def to_brute(self, upper: bool) -> MoveBrute:
         """Convert the move to brute representation."""
         piece = self.piece_str(upper)
@@ -360,403 +649,3040 @@ class State(IntEnum):
         return self
 
 
-class Node:
-    """Node in the minimax tree."""
+INFINITY = 1 << 30
+"""Bound larger than any evaluation score"""
+
+MAX_DEPTH = 64
+"""Maximum depth of the iterative deepening"""
+
+ASPIRATION_WINDOW = 150
+"""Initial distance of the aspiration window bounds from the expected score"""
+
+QUIESCENCE_PRESSURE = 4
+"""Number of neighbors of a queen from which the quiescence search is used"""
+
+QUIESCENCE_NODES = 32
+"""Maximum number of nodes searched by a single quiescence search"""
+
+NULL_MOVE_DEPTH = 3
+"""Minimal depth at which the search tries passing the turn (null move)"""
+
+NULL_MOVE_REDUCTION = 2
+"""How much shallower the position after a null move is searched"""
+
+REDUCTION_MOVES = 3
+"""Number of moves searched to the full depth before the reductions start"""
+
+REDUCTION_DEPTH = 3
+"""Minimal depth at which the late quiet moves are searched shallower"""
+
+WIDENING_SCALE = 2.0
+"""Children of a Monte Carlo node allowed per a visit to the `widening` power"""
+
+
+@dataclass
+class SelectivityPolicy:
+    """
+    Decides which moves the searches skip or search shallower.
+
+    Trades the depth of the search for its width, see `SELECTIVITY_PRESETS`.
+    """
 
     __slots__ = (
-        "move",
-        "player",
-        "score",
-        "children",
-        "depth",
-        "state",
+        "name",
+        "root_widths",
+        "null_move",
+        "reductions",
+        "widening",
     )
 
-    move: Move
-    player: Player
-    score: int
-    children: list[Node]
+    name: str
+    root_widths: list[tuple[int, int]]
+    """
+    Pairs of an iteration and the number of the best root moves kept after it,
+    until the next pair, all of the moves are kept before the first one
+    """
+    null_move: bool
+    reductions: bool
+    """Search the late quiet moves shallower"""
+    widening: float | None
+    """Exponent of the progressive widening of the Monte Carlo nodes"""
+
+    def root_width(self, depth: int) -> int | None:
+        """Return how many root moves are kept after the iteration, `None` for all."""
+        width = None
+
+        for start, count in self.root_widths:
+            if depth >= start:
+                width = count
+
+        return width
+
+    def children_limit(self, visits: int) -> float:
+        """Return how many children a Monte Carlo node with the visits can have."""
+        if self.widening is None:
+            return math.inf
+
+        return max(math.ceil(WIDENING_SCALE * math.pow(visits, self.widening)), 1)
+
+
+SELECTIVITY_PRESETS = {
+    policy.name: policy
+    for policy in (
+        SelectivityPolicy("full-width", [], False, False, None),
+        SelectivityPolicy("default", [(4, 5), (7, 2)], True, True, None),
+        SelectivityPolicy("beam", [(2, 4), (4, 2)], True, True, None),
+        SelectivityPolicy("progressive", [(4, 5), (7, 2)], True, True, 0.5),
+    )
+}
+"""
+Named selectivity policies.
+
+`full-width` searches all moves to the full depth, `default` prunes the root
+moves with the deepening and reduces the late quiet moves in the nodes, `beam`
+narrows the root faster to get deeper and `progressive` on top of the default
+widens the Monte Carlo nodes gradually with their visits.
+"""
+
+TERMINAL_SCORES = {
+    State.WIN: EVAL_TABLE_RIVAL[Criteria.QUEEN_SURROUNDED],
+    State.LOSS: EVAL_TABLE_MY[Criteria.QUEEN_SURROUNDED],
+    State.DRAW: 0,
+}
+"""Scores of the finished games, matching the ones from `evaluate_cell`"""
+
+
+class Bound(IntEnum):
+    """Meaning of the score stored in the transposition table."""
+
+    EXACT = 0
+    LOWER = 1
+    """The real score is at least the stored one (search failed high)"""
+    UPPER = 2
+    """The real score is at most the stored one (search failed low)"""
+
+    @staticmethod
+    def of(score: int, alpha: int, beta: int) -> Bound:
+        """Return the bound of a score returned by a search with given window."""
+        if score <= alpha:
+            return Bound.UPPER
+
+        if score >= beta:
+            return Bound.LOWER
+
+        return Bound.EXACT
+
+
+@dataclass
+class TableEntry:
+    """Result of searching a single position, stored in `TranspositionTable`."""
+
+    __slots__ = ("key", "depth", "score", "state", "bound", "move", "age")
+
+    key: int
     depth: int
+    score: int
     state: State
+    bound: Bound
+    move: Move | None
+    age: int
 
-    def __init__(
+    def is_usable(self, depth: int, alpha: int, beta: int) -> bool:
+        """Check if the entry determines the result of a search with given params."""
+        if self.depth < depth:
+            return False
+
+        bound = self.bound
+
+        return (
+            bound == Bound.EXACT
+            or (bound == Bound.LOWER and self.score >= beta)
+            or (bound == Bound.UPPER and self.score <= alpha)
+        )
+
+
+class TranspositionTable:
+    """
+    Fixed size hash table of the search results indexed by Zobrist keys.
+
+    Every key maps to a single slot. An occupied slot is replaced by results
+    searched at least as deep as the stored one, or when the stored one comes from
+    an older search.
+    """
+
+    __slots__ = ("entries", "mask", "age", "probes", "hits")
+
+    entries: list[TableEntry | None]
+    mask: int
+    age: int
+    probes: int
+    hits: int
+
+    def __init__(self, size: int = 1 << 16) -> None:
+        """Create a table with `size` slots, rounded up to a power of two."""
+        slots = 1 << max(size - 1, 0).bit_length()
+        self.entries = [None] * slots
+        self.mask = slots - 1
+        self.age = 0
+        self.probes = 0
+        self.hits = 0
+
+    def __len__(self) -> int:
+        """Return the number of occupied slots."""
+        return sum(entry is not None for entry in self.entries)
+
+    def new_search(self) -> None:
+        """Mark all the stored entries as old, making them preferred for replacing."""
+        self.age += 1
+        self.probes = 0
+        self.hits = 0
+
+    def clear(self) -> None:
+        """Remove all the entries."""
+        self.entries = [None] * len(self.entries)
+
+    def probe(self, key: int) -> TableEntry | None:
+        """Return the entry stored for the given key, if there is any."""
+        self.probes += 1
+
+        entry = self.entries[key & self.mask]
+
+        if entry is None or entry.key != key:
+            return None
+
+        self.hits += 1
+        return entry
+
+    def store(
         self,
-        move: Move,
-        player: Player,
+        key: int,
+        depth: int,
+        score: int,
+        state: State,
+        bound: Bound,
+        move: Move | None,
     ) -> None:
-        """
-        Initialize the node.
+        """Store the result of a search, unless a more valuable one is in the slot."""
+        index = key & self.mask
+        entry = self.entries[index]
 
-        `player` is the one holding the board, not the evaluation target. That is
-        specified when calling `next_depth`.
-        """
-        self.move = move
-        self.player = player
-        self.score = 0
-        self.children = []
-        self.depth = 0
-        self.state = State.RUNNING
+        if entry is not None and entry.age == self.age and entry.depth > depth:
+            return
 
-    def next_depth(self, player: Player, end: float, *, target_player: bool) -> bool:
-        """
-        Compute the next depth using the minimax algorithm.
+        self.entries[index] = TableEntry(
+            key, depth, score, state, bound, move, self.age
+        )
 
-        First call evaluates the current position, second call creates
-        the children of the current node and all next calls, call
-        this function recursively on the children.
 
-        Returns True if it finished computing the next depth before
-        time specified in `end`, otherwise returns False. When that happens,
-        the results should be discarded, since they are only half done and
-        thus not accurate.
-        """
-        if self.state.is_end():
-            return True
+SCORE_BITS = 24
+"""Bits of a packed score, enough for the terminal scores with a wide margin"""
 
-        if time.perf_counter() > end:
-            return False
+SCORE_LIMIT = (1 << (SCORE_BITS - 1)) - 1
+"""Largest magnitude of a packed score, bigger ones are clamped"""
 
-        self.depth += 1
+CELL_BITS = 10
+"""Bits of a packed cell index, enough for boards up to size 31"""
 
-        with play_move(player, self.move):
-            if self.depth == 1:
-                self.score, self.state = evaluate_position(
-                    self.player,
-                    target_player=target_player,
-                )
-                return True
 
-            if self.depth == 2:
-                self.children = [Node(move, player) for move in player.valid_moves]
+class MovePacking:
+    """
+    Packs moves into numbers, for storing them in flat arrays.
 
-            for child in self.children:
-                if not child.next_depth(
-                    player,
-                    end,
-                    target_player=not target_player,
-                ):
-                    return False
+    From the lowest bits: 3 bits the piece kind (plus one, so that zero means no
+    move), `CELL_BITS` the start cell index (one past the last cell for
+    a placement) and `CELL_BITS` the end cell index.
+    """
+
+    __slots__ = ("cells", "cell_index")
+
+    cells: list[Cell]
+    cell_index: dict[Cell, int]
+
+    def __init__(self, size: int) -> None:
+        """Index the cells of a board of the given size."""
+        tables = BoardTables.for_size(size)
+        self.cells = tables.cells
+        self.cell_index = tables.cell_index
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def for_size(size: int) -> MovePacking:
+        """Return the packing for the given board size, shared by all players."""
+        return MovePacking(size)
+
+    def pack(self, move: Move | None) -> int:
+        """Pack the move into a number, zero meaning no move."""
+        if move is None:
+            return 0
+
+        start = len(self.cells) if move.start is None else self.cell_index[move.start]
+        end = self.cell_index[move.end]
+
+        return (KIND_INDEX[move.piece] + 1) | start << 3 | end << 3 + CELL_BITS
+
+    def unpack(self, packed: int) -> Move | None:
+        """Unpack a move packed by `pack`."""
+        if packed == 0:
+            return None
+
+        cell_mask = (1 << CELL_BITS) - 1
+        kind = (packed & 0x7) - 1
+        start = packed >> 3 & cell_mask
+        end = packed >> 3 + CELL_BITS & cell_mask
+
+        return Move(
+            KINDS[kind],
+            self.cells[start] if start < len(self.cells) else None,
+            self.cells[end],
+        )
+
+
+class SharedTranspositionTable:
+    """
+    Transposition table in shared memory, used by all of the parallel workers.
+
+    Mirrors the interface and replacement rules of `TranspositionTable`. Every
+    entry is packed into a single 64-bit word (from the lowest bits: 24 bits score,
+    7 depth, 2 state, 2 bound, 6 age and 23 move) and stored with the key XOR-ed
+    with it. The workers access the table
+    without any locking, because a slot torn by concurrent writes fails the key
+    check and reads as empty.
+    """
+
+    __slots__ = ("slots", "info", "mask", "packing", "probes", "hits")
+
+    slots: Any
+    """Pairs of words (key XOR data, data), in `multiprocessing` shared memory"""
+    info: Any
+    """Shared search age, so all the processes agree on it"""
+    mask: int
+    packing: MovePacking
+    probes: int
+    hits: int
+
+    def __init__(self, board_size: int, size: int = 1 << 16) -> None:
+        """Create a table with `size` slots, rounded up to a power of two."""
+        slots = 1 << max(size - 1, 0).bit_length()
+        self.slots = RawArray("Q", 2 * slots)
+        self.info = RawArray("Q", 1)
+        self.mask = slots - 1
+        self.packing = MovePacking.for_size(board_size)
+        self.probes = 0
+        self.hits = 0
+
+    @property
+    def age(self) -> int:
+        """Age of the current search, shared by all of the processes."""
+        return int(self.info[0])
+
+    def __len__(self) -> int:
+        """Return the number of occupied slots."""
+        return sum(data != 0 for data in self.slots[1::2])
+
+    def new_search(self) -> None:
+        """Mark all the stored entries as old, making them preferred for replacing."""
+        self.info[0] += 1
+        self.probes = 0
+        self.hits = 0
+
+    def clear(self) -> None:
+        """Remove all the entries."""
+        self.slots[:] = [0] * len(self.slots)
+
+    def probe(self, key: int) -> TableEntry | None:
+        """Return the entry stored for the given key, if there is any."""
+        self.probes += 1
+
+        index = (key & self.mask) << 1
+        data = self.slots[index + 1]
+
+        if data == 0 or self.slots[index] ^ data != key:
+            return None
+
+        self.hits += 1
+        return self.unpack(key, data)
+
+    def store(
+        self,
+        key: int,
+        depth: int,
+        score: int,
+        state: State,
+        bound: Bound,
+        move: Move | None,
+    ) -> None:
+        """Store the result of a search, unless a more valuable one is in the slot."""
+        index = (key & self.mask) << 1
+        data = self.slots[index + 1]
+        age = self.age & 0x3F
+
+        if data != 0 and data >> 35 & 0x3F == age and data >> 24 & 0x7F > depth:
+            return
+
+        score = min(max(score, -SCORE_LIMIT), SCORE_LIMIT) + SCORE_LIMIT
+        data = (
+            score
+            | depth << 24
+            | state << 31
+            | bound << 33
+            | age << 35
+            | self.packing.pack(move) << 41
+        )
+
+        self.slots[index] = key ^ data
+        self.slots[index + 1] = data
+
+    def unpack(self, key: int, data: int) -> TableEntry:
+        """Unpack the entry stored in the given word."""
+        return TableEntry(
+            key,
+            data >> 24 & 0x7F,
+            (data & (1 << SCORE_BITS) - 1) - SCORE_LIMIT,
+            State(data >> 31 & 0x3),
+            Bound(data >> 33 & 0x3),
+            self.packing.unpack(data >> 41),
+            data >> 35 & 0x3F,
+        )
+
+
+class SearchTimeout(Exception):  # noqa: N818
+    """Raised inside of the search when it runs out of time."""
+
+
+class WatchdogTimeout(Exception):  # noqa: N818
+    """
+    Raised by the watchdog when the move is about to exceed the hard limit.
+
+    Can interrupt any code, even in the middle of updating the board, so unlike
+    `SearchTimeout` it isn't handled by the search, only by `Player.move`, which
+    then has to reload the board. Reversing the moves on the way out can fail on
+    the broken board with any other exception.
+    """
+
+
+@dataclass
+class SearchResult:
+    """Result of searching a move in the root."""
+
+    __slots__ = ("move", "score", "state", "depth", "line")
+
+    move: Move
+    score: int
+    state: State
+    depth: int
+    line: list[Move]
+    """Principal variation, the expected continuation starting with `move`"""
+
+
+MOVE_BUDGET = 1.0
+"""Time in seconds for a single move, given by the rules"""
+
+TIME_MARGIN = 0.1
+"""Default part of `MOVE_BUDGET` left unused, as a reserve for overruns"""
+
+DEFAULT_GROWTH = 4.0
+"""Expected ratio of times of two consecutive iterations, before it is measured"""
+
+MIN_GROWTH = 1.5
+MAX_GROWTH = 10.0
+
+STABLE_ITERATIONS = 4
+"""Iterations with the same best move, after which the move is considered stable"""
+
+STABLE_FRACTION = 0.5
+"""Part of the time after which the search stops with a stable best move"""
+
+WATCHDOG_MARGIN = 0.05
+"""
+Time before the end of `MOVE_BUDGET` when the watchdog interrupts the move
+
+Covers unwinding the search, after which the move returns the fallback right
+away. It has to be smaller than `TIME_MARGIN`, so that the watchdog doesn't
+hit the usual small overruns of the search.
+"""
+
+
+@contextmanager
+def watchdog(end: float) -> Iterator[list[bool]]:
+    """
+    Raise `WatchdogTimeout` in the context once the deadline passes.
+
+    Yields a flag, which is set when the watchdog fired. Uses a real-time timer
+    signal, so it works only in the main thread and on systems that support it,
+    elsewhere (or without a deadline) the context does nothing. A timer armed
+    before is suspended for the duration of the context and re-armed with its
+    remaining time afterwards, firing right away if it already elapsed.
+    """
+    fired = [False]
+
+    if (
+        end == math.inf
+        or not hasattr(signal, "setitimer")
+        or threading.current_thread() is not threading.main_thread()
+    ):
+        yield fired
+        return
+
+    def interrupt(_signum: int, _frame: Any) -> None:
+        fired[0] = True
+        raise WatchdogTimeout
+
+    previous = signal.signal(signal.SIGALRM, interrupt)
+    armed = time.perf_counter()
+    delay, interval = signal.setitimer(signal.ITIMER_REAL, max(end - armed, 0.001))
+
+    try:
+        yield fired
+    finally:
+        try:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        finally:
+            signal.signal(signal.SIGALRM, previous)
+
+            if delay > 0:
+                remaining = delay - (time.perf_counter() - armed)
+                signal.setitimer(signal.ITIMER_REAL, max(remaining, 0.001), interval)
+
+
+class TimeManager:
+    """
+    Decides if the iterative deepening should go on with another iteration.
+
+    The time of the next iteration is predicted from the times of the previous
+    ones per a root move, which grow by the effective branching factor, since the
+    number of the root moves changes between the iterations. An iteration is
+    started only when at least its first move (the previous best one) can be
+    finished in time, since until then the unfinished iteration can't change
+    the result at all. The search also stops early when the best move hasn't
+    changed for several iterations.
+    """
+
+    __slots__ = ("start", "end", "times", "best_move", "stable", "reason")
+
+    start: float
+    end: float
+    times: list[float]
+    """Durations of the finished iterations per a searched root move"""
+    best_move: Move | None
+    stable: int
+    """Number of the last iterations that ended with the same best move"""
+    reason: str
+    """Why the search stopped, for the statistics"""
+
+    def __init__(self, end: float) -> None:
+        """Start measuring the time of a search with the given deadline."""
+        self.start = time.perf_counter()
+        self.end = end
+        self.times = []
+        self.best_move = None
+        self.stable = 0
+        self.reason = "max depth"
+
+    def record(self, duration: float, moves: int, best_move: Move) -> None:
+        """Record a finished iteration over the given number of root moves."""
+        self.times.append(duration / moves)
+
+        if best_move == self.best_move:
+            self.stable += 1
+        else:
+            self.best_move = best_move
+            self.stable = 1
+
+    def predicted_time(self, moves: int) -> float:
+        """Return the expected duration of the next iteration over `moves` moves."""
+        times = self.times
+
+        if not times:
+            return 0
+
+        if len(times) < 2 or times[-2] <= 0:
+            growth = DEFAULT_GROWTH
+        else:
+            growth = min(max(times[-1] / times[-2], MIN_GROWTH), MAX_GROWTH)
+
+        return times[-1] * growth * moves
+
+    def should_continue(self) -> bool:
+        """Check if another iteration should be started."""
+        now = time.perf_counter()
+
+        if now + self.predicted_time(1) > self.end:
+            self.reason = "predicted timeout"
+            return False
+
+        stable_time = self.start + (self.end - self.start) * STABLE_FRACTION
+
+        if self.stable >= STABLE_ITERATIONS and now > stable_time:
+            self.reason = "stable best move"
+            return False
+
+        return True
+
+
+class Search:
+    """
+    Depth-first alpha-beta search in the negamax formulation.
+
+    Moves are played directly on the board of the player and reversed on the way
+    back, so only the current path is held in memory. All scores are from the POV
+    of the player to move in the given position.
+    """
+
+    __slots__ = (
+        "player",
+        "end",
+        "nodes",
+        "best_move",
+        "best_score",
+        "best_state",
+        "results",
+        "ranking",
+        "multi_pv",
+        "killers",
+        "history",
+        "cutoffs",
+        "first_cutoffs",
+        "researches",
+        "null_cutoffs",
+        "reductions",
+        "root_pruned",
+        "selectivity",
+        "clock",
+        "path",
+        "repetitions",
+        "quiescence_nodes",
+        "quiescence_budget",
+        "stop",
+        "node_limit",
+    )
+
+    player: Player
+    end: float
+    nodes: int
+    best_move: Move | None
+    best_score: int
+    best_state: State
+    results: list[tuple[Move, int, State]]
+    ranking: list[tuple[Move, int, State]]
+    """Results of the last finished iteration, the best first"""
+    multi_pv: int
+    """Number of the best root moves that get exact scores"""
+    killers: dict[int, list[Move]]
+    """Last two moves that caused a cutoff at the given ply"""
+    history: dict[tuple[PieceKind, Cell], int]
+    """How much each move caused cutoffs, indexed by the piece kind and target cell"""
+    cutoffs: int
+    first_cutoffs: int
+    researches: int
+    null_cutoffs: int
+    reductions: int
+    root_pruned: int
+    selectivity: SelectivityPolicy
+    clock: TimeManager
+    path: set[int]
+    """Keys of the positions on the current path and earlier in the game"""
+    repetitions: int
+    quiescence_nodes: int
+    quiescence_budget: int
+    """Nodes left for the currently running quiescence search"""
+    stop: Any | None
+    """Shared flag of the player, stops the search when set"""
+    node_limit: float
+    """Number of nodes after which the search stops, like after the deadline"""
+
+    def __init__(self, player: Player, end: float) -> None:
+        """
+        Initialize the search.
+
+        `player` is the one holding the board, `end` is the deadline given
+        by `time.perf_counter`.
+        """
+        self.player = player
+        self.end = end
+        self.nodes = 0
+        self.best_move = None
+        self.best_score = -INFINITY
+        self.best_state = State.RUNNING
+        self.results = []
+        self.ranking = []
+        self.multi_pv = 1
+        self.killers = {}
+        self.history = {}
+        self.cutoffs = 0
+        self.first_cutoffs = 0
+        self.researches = 0
+        self.null_cutoffs = 0
+        self.reductions = 0
+        self.root_pruned = 0
+        self.selectivity = player.selectivity
+        self.clock = TimeManager(end)
+        self.path = {*player.game_positions, player.zobrist}
+        self.repetitions = 0
+        self.quiescence_nodes = 0
+        self.quiescence_budget = 0
+        self.stop = player.stop
+        self.node_limit = player.node_limit or math.inf
+
+    def check_time(self) -> None:
+        """Raise `SearchTimeout` if the deadline or the node limit has passed."""
+        if (
+            self.nodes > self.node_limit
+            or time.perf_counter() > self.end
+            or self.stop is not None
+            and self.stop[0]
+        ):
+            raise SearchTimeout
+
+    def root(
+        self,
+        moves: list[Move],
+        depth: int,
+        alpha: int = -INFINITY,
+        beta: int = INFINITY,
+    ) -> None:
+        """
+        Search all the moves in the root to the given depth.
+
+        Moves are searched in the given order and the best one found so far is
+        stored in `best_move`, `best_score` and `best_state`, so it can be used
+        even when the iteration doesn't finish. Scores of all searched moves are
+        collected in `results`.
+
+        With `multi_pv` above one, the window is raised only by the score of the
+        `multi_pv`-th best move, so that all of the best moves get exact scores.
+
+        When the best score falls outside of the window (`alpha`, `beta`), it is
+        only a bound and the search has to be repeated with a wider window.
+        """
+        player = self.player
+        original_alpha = alpha
+
+        self.best_move = None
+        self.best_score = -INFINITY
+        self.best_state = State.RUNNING
+        self.results = []
+
+        for index, move in enumerate(moves):
+            with play_move(player, move, player.upper):
+                score, state = self.principal_variation(
+                    depth - 1,
+                    alpha,
+                    beta,
+                    ply=1,
+                    target_player=not player.upper,
+                    first=index < self.multi_pv,
+                )
+
+            self.results.append((move, score, state))
+
+            if self.best_move is None or score > self.best_score:
+                self.best_move = move
+                self.best_score = score
+                self.best_state = state
+
+                if state == State.WIN and self.multi_pv == 1:
+                    break
+
+            if len(self.results) >= self.multi_pv:
+                scores = sorted((result[1] for result in self.results), reverse=True)
+                alpha = max(alpha, scores[self.multi_pv - 1])
+
+                if alpha >= beta:
+                    break
+
+        player.table.store(
+            player.zobrist,
+            depth,
+            self.best_score,
+            self.best_state,
+            Bound.of(self.best_score, original_alpha, beta),
+            self.best_move,
+        )
+
+    def aspiration(self, moves: list[Move], depth: int, expected: int | None) -> None:
+        """
+        Search the root with a narrow window around the expected score.
+
+        Whenever the result falls outside of the window, the search is repeated
+        with the window widened on that side. Without the expected score, or when
+        searching multiple principal variations, searches with the full window.
+        """
+        if expected is None or self.multi_pv > 1:
+            self.root(moves, depth)
+            return
+
+        delta = ASPIRATION_WINDOW
+        alpha, beta = expected - delta, expected + delta
+
+        while True:
+            self.root(moves, depth, alpha, beta)
+
+            if self.best_score <= alpha:
+                alpha = self.best_score - delta
+            elif self.best_score >= beta:
+                beta = self.best_score + delta
+            else:
+                return
+
+            delta *= 4
+            self.researches += 1
+
+    def principal_variation(
+        self,
+        depth: int,
+        alpha: int,
+        beta: int,
+        *,
+        ply: int,
+        target_player: bool,
+        first: bool,
+        reduction: int = 0,
+    ) -> tuple[int, State]:
+        """
+        Search the position after a move from the POV of the player who made it.
+
+        The first move of a node is expected to be the best one and is searched
+        with the full window. All the others are only tested with a zero window
+        to prove that they are worse and they are searched again with the full
+        window only when they turn out to be better.
+
+        With a `reduction`, the zero window test is first done that much shallower
+        and the move is searched to the full depth only when it doesn't fail low.
+        """
+        if reduction:
+            self.reductions += 1
+
+            score, state = self.negamax(
+                depth - reduction,
+                -alpha - 1,
+                -alpha,
+                ply=ply,
+                target_player=target_player,
+            )
+
+            if -score <= alpha:
+                return -score, state.inverse()
+
+            self.researches += 1
+
+        if not first:
+            score, state = self.negamax(
+                depth,
+                -alpha - 1,
+                -alpha,
+                ply=ply,
+                target_player=target_player,
+            )
+
+            if not alpha < -score < beta:
+                return -score, state.inverse()
+
+            self.researches += 1
+
+        score, state = self.negamax(
+            depth,
+            -beta,
+            -alpha,
+            ply=ply,
+            target_player=target_player,
+        )
+
+        return -score, state.inverse()
+
+    def negamax(
+        self,
+        depth: int,
+        alpha: int,
+        beta: int,
+        *,
+        ply: int,
+        target_player: bool,
+        null_move: bool = True,
+    ) -> tuple[int, State]:
+        """
+        Evaluate the current position by searching `depth` plies ahead.
+
+        Branches that fall outside of the window (`alpha`, `beta`) are cut off,
+        so the returned score is exact only when it lies inside of it, otherwise
+        it is just a bound.
+
+        Outside of the principal variation, the search first tries to pass the
+        turn (unless `null_move` is false, after another pass). When even that
+        fails high, the position is most likely too good to be reached.
+
+        A position repeated on the path or from earlier in the game is a draw,
+        since the player who repeated it can always repeat it again.
+        """
+        self.nodes += 1
+        self.check_time()
+
+        player = self.player
+        table = player.table
+        key = player.zobrist
+
+        if key in self.path:
+            self.repetitions += 1
+            return TERMINAL_SCORES[State.DRAW], State.DRAW
+
+        if depth <= 0:
+            self.quiescence_budget = QUIESCENCE_NODES
+            return self.quiescence(alpha, beta, target_player=target_player)
+
+        entry = table.probe(key)
+        table_move = None
+
+        if entry is not None:
+            if entry.is_usable(depth, alpha, beta):
+                return entry.score, entry.state
+
+            table_move = entry.move
+
+        state = player.game_state(target_player)
+        queens = self.pressured_queens()
+
+        if (
+            null_move
+            and self.selectivity.null_move
+            and depth >= NULL_MOVE_DEPTH
+            and beta - alpha == 1
+            and not state.is_end()
+            and (target_player not in (upper for _, upper in queens))
+            and self.null_move_fails_high(depth, beta, ply, target_player)
+        ):
+            return beta, State.RUNNING
+
+        moves = [] if state.is_end() else list(player.moves_of(target_player))
+
+        if not moves:
+            if not state.is_end():
+                state = State.DRAW
+
+            score = TERMINAL_SCORES[state]
+            table.store(key, MAX_DEPTH, score, state, Bound.EXACT, None)
+            return score, state
+
+        if depth >= 2:
+            self.sort_moves(moves, target_player=target_player)
+
+        moves = self.order_moves(moves, ply, table_move)
+
+        self.path.add(key)
+
+        try:
+            best_score, best_state, best_move = self.search_moves(
+                moves,
+                depth,
+                alpha,
+                beta,
+                ply=ply,
+                target_player=target_player,
+                table_move=table_move,
+                queens=[cell for cell, _ in queens],
+            )
+        finally:
+            self.path.discard(key)
+
+        bound = Bound.of(best_score, alpha, beta)
+        table.store(key, depth, best_score, best_state, bound, best_move)
+
+        return best_score, best_state
+
+    def search_moves(
+        self,
+        moves: list[Move],
+        depth: int,
+        alpha: int,
+        beta: int,
+        *,
+        ply: int,
+        target_player: bool,
+        table_move: Move | None,
+        queens: list[Cell],
+    ) -> tuple[int, State, Move | None]:
+        """
+        Search the ordered moves of a node and return the best score, state and move.
+
+        Quiet moves late in the order are searched shallower.
+        """
+        player = self.player
+        killers = self.killers.get(ply, [])
+        selectivity = self.selectivity
+
+        best_score = -INFINITY
+        best_state = State.LOSS
+        best_move = None
+
+        for index, move in enumerate(moves):
+            quiet = (
+                index >= REDUCTION_MOVES
+                and move != table_move
+                and move not in killers
+                and not self.is_tactical(move, queens)
+            )
+
+            reduction = (
+                self.reduction(depth, index) if quiet and selectivity.reductions else 0
+            )
+
+            with play_move(player, move, target_player):
+                score, state = self.principal_variation(
+                    depth - 1,
+                    alpha,
+                    beta,
+                    ply=ply + 1,
+                    target_player=not target_player,
+                    first=index == 0,
+                    reduction=reduction,
+                )
+
+            if score > best_score:
+                best_score = score
+                best_state = state
+                best_move = move
+
+                if score > alpha:
+                    alpha = score
+
+                    if alpha >= beta:
+                        self.store_cutoff(move, depth, ply, first=index == 0)
+                        break
+
+        return best_score, best_state, best_move
+
+    def null_move_fails_high(
+        self,
+        depth: int,
+        beta: int,
+        ply: int,
+        target_player: bool,
+    ) -> bool:
+        """
+        Check if the position stays above `beta`, even if the player passes.
+
+        Tried only when the static evaluation is already above `beta`. Wins are
+        not trusted, because passing is not a legal move.
+        """
+        player = self.player
+
+        static, _ = self.evaluate(target_player=target_player)
+
+        if static < beta:
+            return False
+
+        player.zobrist ^= player.keys.side
+
+        try:
+            score, state = self.negamax(
+                depth - 1 - NULL_MOVE_REDUCTION,
+                -beta,
+                -beta + 1,
+                ply=ply + 1,
+                target_player=not target_player,
+                null_move=False,
+            )
+        finally:
+            player.zobrist ^= player.keys.side
+
+        if -score < beta or state.is_end():
+            return False
+
+        self.null_cutoffs += 1
+        return True
+
+    def reduction(self, depth: int, index: int) -> int:
+        """Return how much shallower to search the quiet move at the given index."""
+        if depth < REDUCTION_DEPTH:
+            return 0
+
+        reduction = int(math.log(depth) * math.log(index + 1) / 2)
+
+        return min(max(reduction, 1), depth - 2)
+
+    def pressured_queens(self) -> list[tuple[Cell, bool]]:
+        """Return the queens with enough neighbors to be in danger."""
+        player = self.player
+
+        return [
+            (cell, upper)
+            for cell, upper in player.queens
+            if length_of_iter(player.neighbors(cell)) >= QUIESCENCE_PRESSURE
+        ]
+
+    def quiescence(
+        self,
+        alpha: int,
+        beta: int,
+        *,
+        target_player: bool,
+    ) -> tuple[int, State]:
+        """
+        Evaluate the position, resolving the fights around queens first.
+
+        While one of the queens is under pressure, the tactical moves (see
+        `is_tactical`) are searched further, so that the evaluation doesn't stop
+        in the middle of surrounding a queen. The player to move can always
+        choose to stop, so the static evaluation is a lower bound. The search
+        ends when it runs out of `quiescence_budget`.
+        """
+        player = self.player
+
+        best_score, best_state = self.evaluate(target_player=target_player)
+
+        if best_state.is_end() or best_score >= beta or self.quiescence_budget <= 0:
+            return best_score, best_state
+
+        queens = [cell for cell, _ in self.pressured_queens()]
+
+        if not queens:
+            return best_score, best_state
+
+        alpha = max(alpha, best_score)
+
+        # the moves have to be generated first, since generating lifts the pieces
+        moves = list(player.moves_of(target_player))
+
+        for move in moves:
+            if not self.is_tactical(move, queens):
+                continue
+
+            if self.quiescence_budget <= 0:
+                break
+
+            self.quiescence_budget -= 1
+            self.quiescence_nodes += 1
+            self.nodes += 1
+            self.check_time()
+
+            with play_move(player, move, target_player):
+                score, state = self.quiescence(
+                    -beta,
+                    -alpha,
+                    target_player=not target_player,
+                )
+
+            score = -score
+
+            if score > best_score:
+                best_score = score
+                best_state = state.inverse()
+
+                if score > alpha:
+                    alpha = score
+
+                    if alpha >= beta:
+                        break
+
+        return best_score, best_state
+
+    def is_tactical(self, move: Move, queens: list[Cell]) -> bool:
+        """
+        Check if the move changes the pressure on any of the given queens.
+
+        That is if it adds or removes a neighbor of a queen, moves the queen
+        itself or climbs a beetle on top of a queen. A beetle climbing anywhere
+        from a cell next to a queen removes that neighbor too.
+        """
+        player = self.player
+        start = move.start
+        end = move.end
+
+        if start in queens:
+            return True
+
+        # the start stays occupied when the piece moves from the top of a stack
+        leaves = start is not None and len(player[start]) == 1
+        arounds = [set(player.neighboring_cells_unchecked(queen)) for queen in queens]
+
+        if player.isnt_empty(end):
+            # climbing doesn't add a neighbor, but it can still free the start
+            return player.top_piece_in(end).kind == PieceKind.Queen or (
+                leaves and any(start in around for around in arounds)
+            )
+
+        return any(
+            (end in around) != (leaves and start in around) for around in arounds
+        )
+
+    def evaluate(self, *, target_player: bool) -> tuple[int, State]:
+        """Evaluate the current position statically, reusing stored evaluations."""
+        player = self.player
+        key = player.zobrist
+        entry = player.table.probe(key)
+
+        if entry is not None and entry.bound == Bound.EXACT:
+            return entry.score, entry.state
+
+        score, state = evaluate_position(player, target_player=target_player)
+        player.table.store(key, 0, score, state, Bound.EXACT, None)
+
+        return score, state
+
+    def sort_moves(self, moves: list[Move], *, target_player: bool) -> None:
+        """
+        Sort the moves by the static evaluation of the resulting position.
+
+        Used as the base order, on top of which `order_moves` puts the moves
+        that caused cutoffs elsewhere.
+        """
+        player = self.player
+
+        def evaluate(move: Move) -> int:
+            with play_move(player, move, target_player):
+                score, _ = self.evaluate(target_player=not target_player)
+            return -score
+
+        moves.sort(key=evaluate, reverse=True)
+
+    def order_moves(
+        self,
+        moves: list[Move],
+        ply: int,
+        table_move: Move | None,
+    ) -> list[Move]:
+        """
+        Order the moves so that the ones most likely to cause a cutoff go first.
+
+        First goes the best move from the transposition table, then the killer
+        moves of this ply and then the rest sorted by the history heuristic. Moves
+        with equal priority keep their relative order.
+        """
+        killers = self.killers.get(ply, [])
+        history = self.history
+
+        def priority(move: Move) -> int:
+            if move == table_move:
+                return INFINITY
+
+            if move in killers:
+                return INFINITY - 1 - killers.index(move)
+
+            return history.get((move.piece, move.end), 0)
+
+        moves.sort(key=priority, reverse=True)
+
+        return moves
+
+    def store_cutoff(self, move: Move, depth: int, ply: int, *, first: bool) -> None:
+        """Remember the move that caused a cutoff, for ordering of other moves."""
+        self.cutoffs += 1
+        self.first_cutoffs += first
+
+        killers = self.killers.setdefault(ply, [])
+
+        if move not in killers:
+            killers.insert(0, move)
+            del killers[2:]
+
+        key = (move.piece, move.end)
+        self.history[key] = self.history.get(key, 0) + depth * depth
+
+
+THREAT_MOVES = 3
+"""Maximum number of my moves in the wins looked for by `ThreatSolver`"""
+
+THREAT_BUDGET = 0.1
+"""Time in seconds given to `ThreatSolver` before the main search"""
+
+
+class ThreatSolver:
+    """
+    Proves forced wins by surrounding the rival's queen in a few of my moves.
+
+    Only my moves into the free cells around the rival's queen are tried, while
+    all of the rival's replies have to be refuted. Positions where the queen has
+    more free cells than I have moves left are given up right away. That makes
+    the solver fast, but it misses wins that need any other moves.
+    """
+
+    __slots__ = ("player", "end", "nodes")
+
+    player: Player
+    end: float
+    nodes: int
+
+    def __init__(self, player: Player, end: float) -> None:
+        """
+        Initialize the solver.
+
+        `player` is the one holding the board, `end` is the deadline given
+        by `time.perf_counter`.
+        """
+        self.player = player
+        self.end = end
+        self.nodes = 0
+
+    def check_time(self) -> None:
+        """Raise `SearchTimeout` if the deadline or the node limit has passed."""
+        limit = self.player.node_limit
+
+        if limit and self.nodes > limit or time.perf_counter() > self.end:
+            raise SearchTimeout
+
+    def solve(self, max_moves: int) -> Move | None:
+        """
+        Return my move that wins in at most `max_moves` of my moves.
+
+        Shorter wins are looked for first. Returns `None` when there is no such
+        win, or when the solver ran out of time.
+        """
+        for count in range(1, max_moves + 1):
+            try:
+                move = self.winning_move(count, self.player.upper)
+            except SearchTimeout:
+                return None
+
+            if move is not None:
+                return move
+
+        return None
+
+    def free_cells(self, upper: bool) -> set[Cell] | None:
+        """Return the empty cells around the queen of the rival of the given player."""
+        player = self.player
+
+        for cell, queen_upper in player.queens:
+            if queen_upper != upper:
+                return set(player.empty_neighboring_cells(cell))
+
+        return None
+
+    def winning_move(self, count: int, upper: bool) -> Move | None:
+        """Return a move of the given player that wins in `count` of their moves."""
+        player = self.player
+        free = self.free_cells(upper)
+
+        if free is None or len(free) > count:
+            return None
+
+        # the moves have to be generated first, since generating lifts the pieces
+        moves = [move for move in player.moves_of(upper) if move.end in free]
+
+        for move in moves:
+            self.nodes += 1
+            self.check_time()
+
+            with play_move(player, move, upper):
+                state = player.game_state(upper)
+
+                if state == State.WIN:
+                    return move
+
+                if state.is_end():
+                    continue
+
+                if count > 1 and self.wins_after_any_reply(count - 1, upper):
+                    return move
+
+        return None
+
+    def wins_after_any_reply(self, count: int, upper: bool) -> bool:
+        """Check if the given player wins in `count` moves after every reply."""
+        player = self.player
+        rival = not upper
+        free = self.free_cells(upper)
+
+        if free is None or len(free) > count:
+            return False
+
+        replies = list(player.moves_of(rival))
+
+        if not replies:
+            return self.winning_move(count, upper) is not None
+
+        # the replies moving the queen or the pieces around it defend the best
+        queen = next(
+            cell for cell, queen_upper in player.queens if queen_upper == rival
+        )
+        around = set(player.neighboring_cells_unchecked(queen))
+        replies.sort(
+            key=lambda reply: reply.start != queen and reply.start not in around
+        )
+
+        for reply in replies:
+            self.nodes += 1
+            self.check_time()
+
+            with play_move(player, reply, rival):
+                state = player.game_state(upper)
+
+                if state == State.WIN:
+                    continue
+
+                if state.is_end() or self.winning_move(count, upper) is None:
+                    return False
+
+        return True
+
+
+class Engine(str, Enum):
+    """Algorithm used to search for the best move."""
+
+    MINIMAX = "minimax"
+    """Iterative deepening alpha-beta search, see `Search`"""
+    MONTE_CARLO = "monte-carlo"
+    """Monte Carlo tree search, see `MonteCarlo`"""
+
+
+EXPLORATION = 1.4
+"""Exploration constant of the UCT formula"""
+
+PLAYOUT_MOVES = 8
+"""Maximum number of moves played in a single playout"""
+
+PLAYOUT_SCALE = 1000
+"""Score at which a playout that didn't end counts as roughly 3/4 of a win"""
+
+DEPTH_ITERATIONS = 200
+"""Iterations of the Monte Carlo search per a ply of `Player.depth_limit`"""
+
+
+TREE_NODES = 1 << 17
+"""Default capacity of the Monte Carlo tree, about 60 bytes per node"""
+
+
+class MonteCarloTree:
+    """
+    Monte Carlo search tree stored in parallel arrays, one item per node.
+
+    Node 0 is the root. Children of a node are allocated all at once when it is
+    expanded, in a contiguous range starting at `first_child`, but only the first
+    `expanded` of them are already part of the tree, the rest are the untried
+    moves. Once the capacity is used up, no more nodes are expanded.
+
+    The arrays are allocated once and recycled by every search of the player,
+    so the search doesn't create any objects for the nodes.
+    """
+
+    __slots__ = (
+        "packing",
+        "capacity",
+        "size",
+        "move",
+        "upper",
+        "parent",
+        "first_child",
+        "child_count",
+        "expanded",
+        "visits",
+        "wins",
+    )
+
+    packing: MovePacking
+    capacity: int
+    size: int
+    """Number of the allocated nodes"""
+    move: array[int]
+    """Packed move leading to the node"""
+    upper: array[int]
+    """Player who made the move"""
+    parent: array[int]
+    first_child: array[int]
+    """Index of the first child, -1 until the node is expanded"""
+    child_count: array[int]
+    expanded: array[int]
+    visits: array[int]
+    wins: array[float]
+    """Sum of the playout results from the POV of the player who made the move"""
+
+    def __init__(self, board_size: int, capacity: int = TREE_NODES) -> None:
+        """Allocate a tree for at most `capacity` nodes."""
+        self.packing = MovePacking.for_size(board_size)
+        self.capacity = capacity
+        self.size = 0
+        self.move = array("L", [0]) * capacity
+        self.upper = array("b", [0]) * capacity
+        self.parent = array("l", [0]) * capacity
+        self.first_child = array("l", [0]) * capacity
+        self.child_count = array("l", [0]) * capacity
+        self.expanded = array("l", [0]) * capacity
+        self.visits = array("l", [0]) * capacity
+        self.wins = array("d", [0]) * capacity
+
+    def reset(self, upper: bool) -> None:
+        """Drop all the nodes and start a new tree, with the root played by `upper`."""
+        self.size = 1
+        self.init_node(0, 0, upper, -1)
+
+    def init_node(self, node: int, move: int, upper: bool, parent: int) -> None:
+        """Initialize the node as a leaf with the given packed move."""
+        self.move[node] = move
+        self.upper[node] = upper
+        self.parent[node] = parent
+        self.first_child[node] = -1
+        self.child_count[node] = 0
+        self.expanded[node] = 0
+        self.visits[node] = 0
+        self.wins[node] = 0.0
+
+    def node_move(self, node: int) -> Move:
+        """Return the move leading to the node."""
+        move = self.packing.unpack(self.move[node])
+        assert move is not None
+        return move
+
+    def allocate_children(self, node: int, moves: list[Move], upper: bool) -> bool:
+        """
+        Allocate the children of the node for the moves, played by `upper`.
+
+        Returns false, leaving the node unexpanded, when the tree is full.
+        """
+        first = self.size
+
+        if first + len(moves) > self.capacity:
+            return False
+
+        pack = self.packing.pack
+
+        for index, move in enumerate(moves, first):
+            self.init_node(index, pack(move), upper, node)
+
+        self.first_child[node] = first
+        self.child_count[node] = len(moves)
+        self.size += len(moves)
+
+        return True
+
+    def add_child(self, node: int) -> int:
+        """Add the next untried child of the node to the tree and return it."""
+        child = self.first_child[node] + self.expanded[node]
+        self.expanded[node] += 1
+        return child
+
+    def select(self, node: int) -> int:
+        """Select the child in the tree with the highest UCT score."""
+        log_visits = math.log(self.visits[node])
+        visits = self.visits
+        wins = self.wins
+
+        first = self.first_child[node]
+        best = first
+        best_score = -math.inf
+
+        for child in range(first, first + self.expanded[node]):
+            child_visits = visits[child]
+            exploration = math.sqrt(log_visits / child_visits)
+            score = wins[child] / child_visits + EXPLORATION * exploration
+
+            if score > best_score:
+                best, best_score = child, score
+
+        return best
+
+
+class MonteCarlo:
+    """
+    Monte Carlo tree search with UCT selection.
+
+    Every iteration walks the tree from the root, playing the moves on the board
+    of the player, expands a single new node and finishes with a short random
+    playout, whose result is propagated back to the root.
+    """
+
+    __slots__ = (
+        "player",
+        "end",
+        "tree",
+        "iterations",
+        "playout_moves",
+        "widening_cuts",
+        "full_tree",
+    )
+
+    player: Player
+    end: float
+    tree: MonteCarloTree
+    iterations: int
+    playout_moves: int
+    widening_cuts: int
+    """Selections made instead of an expansion, because of progressive widening"""
+    full_tree: int
+    """Expansions skipped, because the tree was full"""
+
+    def __init__(self, player: Player, end: float) -> None:
+        """
+        Initialize the search.
+
+        `player` is the one holding the board, `end` is the deadline given
+        by `time.perf_counter`.
+        """
+        self.player = player
+        self.end = end
+        self.tree = player.monte_carlo_tree()
+        self.iterations = 0
+        self.playout_moves = 0
+        self.widening_cuts = 0
+        self.full_tree = 0
+
+    def run(self, moves: list[Move]) -> Move:
+        """
+        Search until the deadline and return the most visited of the moves.
+
+        In the deterministic mode, the search stops after `Player.node_limit`
+        iterations instead, or the ones given by `Player.depth_limit`, since
+        the tree has no fixed depth.
+        """
+        player = self.player
+        tree = self.tree
+        limit = player.node_limit or math.inf
+
+        if not player.node_limit and player.depth_limit < MAX_DEPTH:
+            limit = player.depth_limit * DEPTH_ITERATIONS
+
+        moves = moves.copy()
+        player.rng.shuffle(moves)
+
+        tree.reset(not player.upper)
+
+        if not tree.allocate_children(0, moves, player.upper):
+            return moves[0]
+
+        try:
+            while time.perf_counter() < self.end and self.iterations < limit:
+                self.iterate()
+        except SearchTimeout:
+            pass
+
+        if not tree.expanded[0]:
+            return moves[0]
+
+        first = tree.first_child[0]
+        best = max(
+            range(first, first + tree.expanded[0]),
+            key=lambda child: tree.visits[child],
+        )
+
+        return tree.node_move(best)
+
+    def iterate(self) -> None:
+        """Run a single iteration of the search."""
+        player = self.player
+        tree = self.tree
+        node = 0
+        path = []
+
+        try:
+            # selection, the nodes are widened gradually with their visits
+            while tree.expanded[node] and (
+                tree.expanded[node] == tree.child_count[node]
+                or self.is_wide_enough(node)
+            ):
+                node = tree.select(node)
+                path.append(node)
+                player.play_move(tree.node_move(node), bool(tree.upper[node]))
+
+            # expansion
+            upper = not tree.upper[node]
+
+            if tree.first_child[node] < 0 and not player.game_state(upper).is_end():
+                moves = list(player.moves_of(upper))
+                player.rng.shuffle(moves)
+
+                if not tree.allocate_children(node, moves, upper):
+                    self.full_tree += 1
+
+            if tree.expanded[node] < tree.child_count[node]:
+                node = tree.add_child(node)
+                path.append(node)
+                player.play_move(tree.node_move(node), upper)
+
+            result = self.playout(not tree.upper[node])
+        finally:
+            for visited in reversed(path):
+                player.reverse_move(tree.node_move(visited), bool(tree.upper[visited]))
+
+        self.iterations += 1
+
+        # backpropagation
+        for visited in chain(path, [0]):
+            tree.visits[visited] += 1
+            tree.wins[visited] += (
+                result if tree.upper[visited] == player.upper else 1 - result
+            )
+
+    def is_wide_enough(self, node: int) -> bool:
+        """Check if the node has all the children its visits allow."""
+        tree = self.tree
+        limit = self.player.selectivity.children_limit(tree.visits[node])
+
+        if tree.expanded[node] < limit:
+            return False
+
+        self.widening_cuts += 1
+        return True
+
+    def playout(self, upper: bool) -> float:
+        """
+        Play random moves from the current position, starting with the given player.
+
+        Returns the result from my POV, between 0 (loss) and 1 (win). When the
+        game doesn't end in `PLAYOUT_MOVES`, the final position is evaluated
+        statically instead.
+        """
+        player = self.player
+        played: list[tuple[Move, bool]] = []
+
+        try:
+            for _ in range(PLAYOUT_MOVES):
+                state = player.game_state(player.upper)
+
+                if state.is_end():
+                    break
+
+                move = player.random_move(upper)
+
+                if move is not None:
+                    player.play_move(move, upper)
+                    played.append((move, upper))
+
+                upper = not upper
+
+            self.playout_moves += len(played)
+
+            state = player.game_state(player.upper)
+
+            if state == State.WIN:
+                return 1.0
+
+            if state == State.LOSS:
+                return 0.0
+
+            if state == State.DRAW:
+                return 0.5
+
+            score, _ = evaluate_position(player, target_player=player.upper)
+            exponent = min(max(-score / PLAYOUT_SCALE, -50), 50)
+            return 1 / (1 + math.exp(exponent))
+        finally:
+            for move, mover in reversed(played):
+                player.reverse_move(move, mover)
+
+
+WORKER_MARGIN = 0.05
+"""Time in seconds reserved for sending the results of workers back"""
+
+PONDER_BUDGET = 30.0
+"""Time limit of pondering, which normally gets stopped by the next move"""
+
+PONDER_STOP_TIMEOUT = 0.05
+"""Time to wait for pondering to stop, after which the workers are restarted"""
+
+
+@dataclass
+class WorkerTask:
+    """Search of a subset of the root moves, sent to a worker process."""
+
+    __slots__ = (
+        "size",
+        "upper",
+        "board",
+        "my_pieces",
+        "rival_pieces",
+        "my_move",
+        "rival_started",
+        "game_positions",
+        "selectivity",
+        "moves",
+        "budget",
+    )
+
+    size: int
+    upper: bool
+    board: BoardDataBrute
+    my_pieces: dict[str, int]
+    rival_pieces: dict[str, int]
+    my_move: int
+    rival_started: bool
+    game_positions: list[int]
+    selectivity: SelectivityPolicy
+    moves: list[MoveBrute]
+    budget: float
+    """Time in seconds the worker has for the search"""
+
+
+type WorkerResult = tuple[MoveBrute, int, State, int, list[MoveBrute]]
+
+worker_players: dict[tuple[int, bool], Player] = {}
+"""Players of the worker process, for both colors, sharing the table"""
+
+
+def init_worker(size: int, table: SharedTranspositionTable, stop: Any) -> None:
+    """
+    Create the players of a new worker process.
+
+    They search with the shared table and watch the shared stop flag.
+    """
+    for upper in (False, True):
+        player = Player("worker", upper, size, {}, {})
+        player.table = table
+        player.stop = stop
+        worker_players[size, upper] = player
+
+
+def search_worker(task: WorkerTask) -> WorkerResult:
+    """
+    Search the moves of the task and return the best one with its result.
+
+    Runs in a worker process, so everything is sent in brute representation.
+    """
+    end = time.perf_counter() + task.budget - WORKER_MARGIN
+
+    player = worker_players[task.size, task.upper]
+
+    player.board = task.board
+    player.myPieces = task.my_pieces
+    player.rivalPieces = task.rival_pieces
+    player.myMove = task.my_move
+    player.load_board()
+    player.rival_started = task.rival_started
+    player.rival_move = task.my_move + task.rival_started
+    player.game_positions = set(task.game_positions)
+    player.selectivity = task.selectivity
+
+    moves = list(map(Move.from_brute, task.moves))
+
+    with player.time_limit(end):
+        result, _ = player.minimax(moves, end)
+
+    return (
+        result.move.to_brute(task.upper),
+        result.score,
+        result.state,
+        result.depth,
+        [move.to_brute(True) for move in result.line],
+    )
+
+
+def warm_up_worker(_: int) -> None:
+    """Do nothing, used only to start up the worker processes ahead of time."""
+
+
+type Symmetry = tuple[int, int, int, int]
+"""Linear map of the hexagonal grid, `(a, b, c, d)` maps (p, q) to (ap + bq, cp + dq)"""
+
+
+def apply_symmetry(symmetry: Symmetry, cell: Cell) -> Cell:
+    """Return the cell mapped by the symmetry."""
+    a, b, c, d = symmetry
+    p, q = cell
+    return a * p + b * q, c * p + d * q
+
+
+def invert_symmetry(symmetry: Symmetry) -> Symmetry:
+    """Return the inverse of the symmetry."""
+    a, b, c, d = symmetry
+    det = a * d - b * c  # always 1 or -1, so it is also its own inverse
+    return d * det, -b * det, -c * det, a * det
+
+
+def compose_symmetries(first: Symmetry, second: Symmetry) -> Symmetry:
+    """Return the symmetry applying `first` and then `second`."""
+    a, b, c, d = second
+    e, f, g, h = first
+    return a * e + b * g, a * f + b * h, c * e + d * g, c * f + d * h
+
+
+ROTATION = (1, 1, -1, 0)
+"""Rotation by one direction to the left, same as `rotate_left`"""
+
+REFLECTION = (0, 1, 1, 0)
+"""Reflection swapping the p and q axes"""
+
+
+def grid_symmetries() -> list[Symmetry]:
+    """Return all 12 symmetries of the hexagonal grid fixing the origin."""
+    symmetries = []
+    rotation = (1, 0, 0, 1)
+
+    for _ in DIRECTIONS:
+        symmetries.append(rotation)
+        symmetries.append(compose_symmetries(rotation, REFLECTION))
+        rotation = compose_symmetries(rotation, ROTATION)
+
+    return symmetries
+
+
+SYMMETRIES = grid_symmetries()
+
+BOOK_PATH = pathlib.Path(__file__).with_name("opening_book.txt")
+"""Optional opening book next to this file, built by `book.py`"""
+
+
+class OpeningBook:
+    """
+    Best moves for known positions, looked up by their canonical keys.
+
+    Moves are stored in the canonical coordinates of the position (see
+    `Player.canonical_position`), so one entry serves all of its symmetric variants.
+    The file has a line per entry: the key, depth of the search that found the
+    move and the move, with cells written as `p,q` and `-` for no cell.
+    """
+
+    __slots__ = ("entries",)
+
+    entries: dict[str, tuple[int, Move]]
+
+    def __init__(self) -> None:
+        """Create an empty book."""
+        self.entries = {}
+
+    def __len__(self) -> int:
+        """Return the number of positions in the book."""
+        return len(self.entries)
+
+    @staticmethod
+    def read(path: str) -> OpeningBook:
+        """Read the book from the file, the book is empty if there is no file."""
+        book = OpeningBook()
+
+        try:
+            with open(path) as file:
+                lines = file.read().splitlines()
+        except OSError:
+            return book
+
+        def parse_cell(string: str) -> Cell | None:
+            if string == "-":
+                return None
+
+            p, q = string.split(",")
+            return int(p), int(q)
+
+        for line in lines:
+            key, depth, piece, start, end = line.split()
+            end_cell = parse_cell(end)
+
+            assert end_cell is not None
+
+            move = Move(PieceKind.from_str(piece), parse_cell(start), end_cell)
+            book.entries[key] = (int(depth), move)
+
+        return book
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def for_path(path: str) -> OpeningBook:
+        """Return the book from the file, shared by all players."""
+        return OpeningBook.read(path)
+
+    def write(self, path: str) -> None:
+        """Write the book to the file."""
+
+        def format_cell(cell: Cell | None) -> str:
+            return "-" if cell is None else f"{cell[0]},{cell[1]}"
+
+        lines = [
+            f"{key} {depth} {move.piece.upper()} {format_cell(move.start)} "
+            f"{format_cell(move.end)}\n"
+            for key, (depth, move) in sorted(self.entries.items())
+        ]
+
+        with open(path, "w") as file:
+            file.writelines(lines)
+
+    def merge(self, other: OpeningBook) -> None:
+        """Add all entries of the other book, unless deeper ones are known."""
+        for key, (depth, move) in other.entries.items():
+            entry = self.entries.get(key)
+
+            if entry is None or entry[0] <= depth:
+                self.entries[key] = (depth, move)
+
+    def lookup(self, player: Player) -> Move | None:
+        """Return the move for the player's position, if it is in the book."""
+        if not self.entries:
+            return None
+
+        key, symmetry, origin = player.canonical_position()
+        entry = self.entries.get(key)
+
+        if entry is None:
+            return None
+
+        _, move = entry
+        inverse = invert_symmetry(symmetry)
+
+        def from_canonical(cell: Cell) -> Cell:
+            return apply_symmetry(inverse, (cell[0] + origin[0], cell[1] + origin[1]))
+
+        start = None if move.start is None else from_canonical(move.start)
+
+        return Move(move.piece, start, from_canonical(move.end))
+
+    def add(self, player: Player, move: Move, depth: int) -> None:
+        """Add the move for the player's position, unless a deeper one is known."""
+        key, symmetry, origin = player.canonical_position()
+        entry = self.entries.get(key)
+
+        if entry is not None and entry[0] > depth:
+            return
+
+        def to_canonical(cell: Cell) -> Cell:
+            p, q = apply_symmetry(symmetry, cell)
+            return p - origin[0], q - origin[1]
+
+        start = None if move.start is None else to_canonical(move.start)
+
+        self.entries[key] = (depth, Move(move.piece, start, to_canonical(move.end)))
+
+
+@contextmanager
+def lift_piece(player: Player, cell: Cell) -> Iterator[Piece]:
+    """Lifts a piece from the board for the duration of the context."""
+    piece = player.remove_piece_from_board(cell)
+    try:
+        yield piece
+    finally:
+        player.add_piece_to_board(cell, piece)
+
+
+@contextmanager
+def play_move(
+    player: Player,
+    move: Move,
+    upper: bool | None = None,
+) -> Iterator[None]:
+    """
+    Plays a move for the duration of the context.
+
+    The move is played by the given player, which defaults to the one holding
+    the board.
+    """
+    if upper is None:
+        upper = player.upper
+
+    player.play_move(move, upper)
+    try:
+        yield
+    finally:
+        player.reverse_move(move, upper)
+
+
+class Player(Board):
+    """
+    A player for the hive game. Public API includes the constructor and the move method.
+
+    ## State:
+    Inner state consists of a set of cells that together create the hive. This is done
+    in order to speed up lot of the calculations inside and thus all of the methods
+    implicitly depends on it. The properties should be independent and stateless,
+    unless explicitly specified otherwise in their docstrings.
+    """
+
+    __slots__ = (
+        "__board",
+        "pinned",
+        "__cached_pinned",
+        "__pinned_need_update",
+        "keys",
+        "zobrist",
+        "tables",
+        "layout",
+        "occupancy",
+        "colors",
+        "kinds",
+        "queen_cells",
+        "placed",
+        "table",
+        "rival_started",
+        "rival_move",
+        "engine",
+        "workers",
+        "pool",
+        "stop",
+        "ponder",
+        "pondering",
+        "book",
+        "time_margin",
+        "deadline",
+        "fallback",
+        "overruns",
+        "max_overrun",
+        "watchdog_timeouts",
+        "interrupted",
+        "game_positions",
+        "rng",
+        "node_limit",
+        "depth_limit",
+        "selectivity",
+        "tree",
+        "tree_nodes",
+        "size",
+        "myColorIsUpper",
+        "myPieces",
+        "rivalPieces",
+        "playerName",
+        "algorithmName",
+    )
+
+    _board: BoardData
+    pinned: set[Cell]
+    __cached_pinned: dict[int, set[Cell]]
+    __pinned_need_update: bool
+    keys: ZobristKeys
+    zobrist: int
+    tables: BoardTables
+    layout: BitboardLayout
+    occupancy: int
+    """Bitboard of the nonempty cells"""
+    colors: list[int]
+    """Bitboards of the cells with a lower and upper piece on top"""
+    kinds: dict[PieceKind, int]
+    """Bitboards of the cells with a piece of the given kind anywhere in the stack"""
+    queen_cells: list[Cell | None]
+    """Cells of the lower and upper queen, None if not placed yet"""
+    placed: list[int]
+    """Number of pieces on the board by `Piece.index`, counterpart of the reserves"""
+    table: TranspositionTable | SharedTranspositionTable
+    rival_started: bool
+    rival_move: int
+    """Index of the rival's next move, counterpart of `myMove`"""
+    engine: Engine
+    workers: int
+    """Number of worker processes of the parallel search, 0 to search serially"""
+    pool: Pool | None
+    stop: Any | None
+    """Flag shared with the workers, stops their searches when set"""
+    ponder: bool
+    """Search the rival's replies in a worker while the rival is thinking"""
+    pondering: AsyncResult[WorkerResult] | None
+    book: OpeningBook
+    time_margin: float
+    """Part of the time for the move left unused, as a reserve for overruns"""
+    deadline: float
+    """Time when the move generation gives up with `SearchTimeout`"""
+    fallback: Move | None
+    """Best move known so far, played when the watchdog interrupts the move"""
+    overruns: int
+    """Number of moves that took longer than the deadline of the search"""
+    max_overrun: float
+    watchdog_timeouts: int
+    interrupted: bool
+    """Whether the watchdog interrupted the last move, which left the state dirty"""
+    game_positions: set[int]
+    """Keys of the positions that already occurred in the game"""
+    rng: Random
+    """Source of all the random choices, seed it to make the games reproducible"""
+    node_limit: int
+    """Maximum number of nodes of a single search, 0 for no limit"""
+    depth_limit: int
+    """Maximum depth of the iterative deepening"""
+    selectivity: SelectivityPolicy
+    tree: MonteCarloTree | None
+    tree_nodes: int
+    """Capacity of the Monte Carlo tree, caps its memory"""
+
+    def __init__(
+        self,
+        player_name: str,
+        my_is_upper: bool,
+        size: int,
+        my_pieces: dict[str, int],
+        rival_pieces: dict[str, int],
+    ) -> None:
+        """
+        Create a new player.
+
+        *Note: the API has to stay this way to be compatible with Brute*
+        """
+        super().__init__(my_is_upper, size, my_pieces, rival_pieces)
+        self.playerName = player_name
+        self.algorithmName = "Maneren v1.1"
+        self.keys = ZobristKeys.for_size(size)
+        self.tables = BoardTables.for_size(size)
+        self.layout = BitboardLayout.for_size(size)
+        self.table = TranspositionTable()
+        self.pinned = set()
+        self.__cached_pinned = {}
+        self.rival_started = False
+        self.engine = Engine.MINIMAX
+        self.workers = 0
+        self.pool = None
+        self.stop = None
+        self.ponder = False
+        self.pondering = None
+        self.book = OpeningBook.for_path(str(BOOK_PATH))
+        self.time_margin = TIME_MARGIN
+        self.deadline = math.inf
+        self.fallback = None
+        self.overruns = 0
+        self.max_overrun = 0
+        self.watchdog_timeouts = 0
+        self.interrupted = False
+        self.game_positions = set()
+        self.rng = Random()
+        self.node_limit = 0
+        self.depth_limit = MAX_DEPTH
+        self.selectivity = SELECTIVITY_PRESETS["default"]
+        self.tree = None
+        self.tree_nodes = TREE_NODES
+        self.load_board()
+
+    @property
+    def upper(self) -> bool:
+        """The player uses uppercased pieces."""
+        return self.myColorIsUpper
+
+    @property
+    def deterministic(self) -> bool:
+        """
+        The search is limited by the nodes or the depth instead of the time.
+
+        The searches then run serially and ignore the clock, so with a seeded
+        `rng` the whole game is reproducible, regardless of the machine.
+        """
+        return bool(self.node_limit) or self.depth_limit < MAX_DEPTH
+
+    @property
+    def cells(self) -> Iterator[Cell]:
+        """Iterator over all cells."""
+        return iter(self.tables.cells)
+
+    @property
+    def empty_cells(self) -> Iterator[Cell]:
+        """Iterator over all empty cells."""
+        return (cell for cell in self.cells if self.is_empty(cell))
+
+    @property
+    def nonempty_cells(self) -> Iterator[Cell]:
+        """Iterator over all nonempty cells."""
+        return iter(self._board.keys())
+
+    @property
+    def valid_placements(self) -> Iterator[Cell]:
+        """Iterator over all my valid placements."""
+        return self.placements(self.upper)
+
+    @property
+    def valid_moves(self) -> Iterator[Move]:
+        """Iterator over all my valid moves."""
+        return self.moves_of(self.upper)
+
+    def pieces_on_board(self, upper: bool) -> Iterator[tuple[Cell, Piece]]:
+        """Return an iterator over the top pieces of the given player."""
+        cells = list(self.layout.cells(self.colors[upper]))
+        return ((cell, self._board[cell][-1]) for cell in cells)
+
+    def pieces_in_reserve(self, upper: bool) -> dict[str, int]:
+        """Return the reserve of pieces of the given player."""
+        return self.myPieces if upper == self.upper else self.rivalPieces
+
+    def placable_pieces(self, upper: bool) -> Iterator[PieceKind]:
+        """Return an iterator over all placable pieces of the given player."""
+        return (
+            PieceKind.from_str(piece)
+            for piece, count in self.pieces_in_reserve(upper).items()
+            if count > 0
+        )
+
+    def movable_pieces(self, upper: bool) -> Iterator[tuple[Cell, Piece]]:
+        """Return an iterator over all movable pieces of the given player."""
+        return (
+            (cell, piece)
+            for cell, piece in self.pieces_on_board(upper)
+            if not self.moving_breaks_hive(cell)
+        )
+
+    def placements(self, upper: bool) -> Iterator[Cell]:
+        """
+        Return an iterator over all valid placements of the given player.
+
+        Expects at least one piece to be already placed. The first placement of
+        a player can touch the pieces of the other one.
+        """
+        layout = self.layout
+        cells = self.around_hive()
+
+        # pieces are indexed with the color in the lowest bit, see `Piece.index`,
+        # all of them count, even the ones buried under the rival's beetles
+        if any(self.placed[upper::2]):
+            cells &= ~layout.neighbors(self.colors[not upper])
+
+        return layout.cells(cells)
+
+    def random_move(self, upper: bool) -> Move | None:
+        """
+        Return a random valid move of the given player, used for fast playouts.
+
+        Instead of generating all the moves, picks a random piece first and
+        generates only its moves. These are biased towards the rival's queen
+        and away from my own queen, like in `evaluate_cell`.
+        """
+        queen_str = PieceKind.Queen.upper() if upper else PieceKind.Queen.lower()
+        queen_placed = self.pieces_in_reserve(upper).get(queen_str, 0) == 0
+
+        # the opening rules are not worth reimplementing
+        if not queen_placed or (upper == self.upper and self.myMove <= 3):
+            moves = list(self.moves_of(upper))
+            return self.rng.choice(moves) if moves else None
+
+        queens = self.queens
+
+        candidates: list[tuple[Cell | None, PieceKind]] = [
+            (None, kind) for kind in self.placable_pieces(upper)
+        ]
+        candidates.extend(
+            (cell, piece.kind) for cell, piece in self.pieces_on_board(upper)
+        )
+        self.rng.shuffle(candidates)
+
+        for cell, kind in candidates:
+            if cell is None:
+                placements = list(self.placements(upper))
+                moves = (
+                    [Move(kind, None, self.rng.choice(placements))]
+                    if placements
+                    else []
+                )
+            elif self.moving_breaks_hive(cell):
+                continue
+            else:
+                moves = list(self.piece_moves(cell, kind))
+
+            if moves:
+                return max(
+                    moves, key=lambda move: self.playout_priority(move, upper, queens)
+                )
+
+        return None
+
+    def playout_priority(
+        self,
+        move: Move,
+        upper: bool,
+        queens: list[tuple[Cell, bool]],
+    ) -> float:
+        """Return a random priority of the move, higher next to the rival's queen."""
+        priority = 0.0
+
+        for queen, queen_upper in queens:
+            if self.tables.distance(move.end, queen) == 1:
+                priority += 1.0 if queen_upper != upper else -1.0
+
+        return priority + 2 * self.rng.random()
+
+    def move_number(self, upper: bool) -> int:
+        """Return the index of the next move of the given player."""
+        return self.myMove if upper == self.upper else self.rival_move
+
+    def moves_of(self, upper: bool) -> Iterator[Move]:
+        """
+        Return an iterator over all valid moves of the given player.
+
+        Pieces can move only after the queen is placed and the queen has to be
+        placed at the latest as the fourth piece. On top of that, I always place
+        the queen as the second piece and then two ants.
+        """
+        move_number = self.move_number(upper)
+        queen_str = PieceKind.Queen.upper() if upper else PieceKind.Queen.lower()
+        queen_placed = self.pieces_in_reserve(upper).get(queen_str, 0) == 0
+
+        if upper == self.upper and 1 <= move_number <= 3:
+            forced = PieceKind.Queen if move_number == 1 else PieceKind.Ant
+        elif not queen_placed and move_number >= 3:
+            forced = PieceKind.Queen
+        else:
+            forced = None
+
+        if forced is not None:
+            return map(
+                functools.partial(Move, forced, None),
+                self.placements(upper),
+            )
+
+        place_iter = (
+            Move(piece, None, cell)
+            for cell, piece in product(
+                self.placements(upper),
+                self.placable_pieces(upper),
+            )
+        )
+
+        def piece_moves(cell: Cell, kind: PieceKind) -> Iterator[Move]:
+            self.check_deadline()
+            return self.piece_moves(cell, kind)
+
+        move_iter = (
+            move
+            for cell, piece in self.movable_pieces(upper)
+            for move in piece_moves(cell, piece.kind)
+        )
+
+        return chain(place_iter, move_iter) if queen_placed else place_iter
+
+    @property
+    def queens(self) -> list[tuple[Cell, bool]]:
+        """List of cells with a queen (even under a beetle) and the queen's color."""
+        return [
+            (cell, piece.upper)
+            for cell in self.layout.cells(self.kinds[PieceKind.Queen])
+            for piece in self._board[cell]
+            if piece.kind == PieceKind.Queen
+        ]
+
+    def find_queen(self, upper: bool) -> Cell | None:
+        """Return a cell with a queen of the given player, if there is any."""
+        return next((cell for cell, queen in self.queens if queen == upper), None)
+
+    @property
+    def cells_around_hive(self) -> set[Cell]:
+        """Set of all cells around the hive."""
+        return set(self.layout.cells(self.around_hive()))
+
+    def around_hive(self) -> int:
+        """Return the bitboard of the empty cells next to the hive."""
+        return self.layout.neighbors(self.occupancy) & ~self.occupancy
+
+    def move(self) -> MoveBrute:
+        """
+        Return a best move for the current self.board.
+
+        Has to first properly initialize self._board.
+
+        Format:
+            [piece, oldP, oldQ, newP, newQ] - move from (oldP, oldQ) to (newP, newQ)
+            [piece, None, None, newP, newQ] - place new at (newP, newQ)
+            [] - no move is possible
+
+        *Note: the API has to stay this way to be compatible with Brute*
+        """
+        start = time.perf_counter()
+
+        if self.deterministic:
+            end = hard_end = math.inf
+        else:
+            end = start + MOVE_BUDGET - self.time_margin
+            hard_end = start + MOVE_BUDGET - WATCHDOG_MARGIN
+
+        self.load_board()
+        self.stop_pondering()
+
+        if self.interrupted:
+            self.recover_from_interrupt()
+
+        self.table.new_search()
+
+        if self.myMove == 0:
+            self.game_positions.clear()
+
+            if not self._board:
+                return Move(PieceKind.Spider, None, (3, 6)).to_brute(self.upper)
+
+            placement = self.rng.choice(list(self.cells_around_hive))
+            return Move(PieceKind.Spider, None, placement).to_brute(self.upper)
+
+        self.game_positions.add(self.zobrist)
+
+        if TEST or not self.tournament:
+            possible_moves = list(self.valid_moves)
+            if not possible_moves:
+                return []
+
+            return self.rng.choice(possible_moves).to_brute(self.upper)
+
+        moves = list(self.valid_moves)
+
+        if not moves:
+            return []
+
+        self.fallback = moves[0]
+
+        # playing a move updates these before the board, the interrupt can split it
+        counters = (
+            self.myPieces.copy(),
+            self.rivalPieces.copy(),
+            self.myMove,
+            self.rival_move,
+        )
+
+        try:
+            with watchdog(hard_end) as fired:
+                with self.time_limit(end):
+                    best = self.best_move(moves, end)
+
+                # still under the watchdog, but past the time limit of the search
+                self.fallback = best
+                replies = self.pondering_replies(best)
+        except Exception:
+            if not fired[0]:
+                raise
+
+            # the cleanup is deferred to the next move, only the fallback is left
+            assert self.fallback is not None
+            best = self.fallback
+            self.myPieces, self.rivalPieces, self.myMove, self.rival_move = counters
+            self.interrupted = True
+            self.watchdog_timeouts += 1
+
+        self.record_overrun(end)
+
+        # the board may be broken by the interrupt, its position is skipped then
+        if not self.interrupted:
+            with play_move(self, best):
+                self.game_positions.add(self.zobrist)
+
+            self.start_pondering(best, replies)
+
+        return best.to_brute(self.upper)
+
+    def best_move(self, moves: list[Move], end: float) -> Move:
+        """Choose the best of the moves, from the book or by the selected engine."""
+        book_move = self.book.lookup(self)
+
+        if book_move is not None and book_move in moves:
+            print(f"Book move: {book_move}")
+            return book_move
+
+        threat_end = min(end, time.perf_counter() + THREAT_BUDGET)
+        solver = ThreatSolver(self, math.inf if self.deterministic else threat_end)
+        winning_move = solver.solve(THREAT_MOVES)
+
+        if winning_move is not None:
+            print(f"Forced win: {winning_move} ({solver.nodes} nodes)")
+            return winning_move
+
+        if self.engine == Engine.MONTE_CARLO:
+            monte_carlo = MonteCarlo(self, end)
+            best = monte_carlo.run(moves)
+
+            print(
+                f"Monte Carlo: {monte_carlo.iterations} iterations,",
+                f"{monte_carlo.playout_moves} playout moves,",
+                f"{monte_carlo.widening_cuts} widening cuts,",
+                f"{monte_carlo.tree.size} nodes ({monte_carlo.full_tree} skipped)",
+            )
+
+            return best
+
+        if self.workers and not self.deterministic:
+            result = self.parallel_minimax(moves, end)
+
+            print(f"Parallel search to depth {result.depth}: {result.score}")
+            print("Line:", ", ".join(map(str, result.line)))
+        else:
+            result, search = self.minimax(moves, end)
+            self.print_statistics(result, search)
+
+        return result.move
+
+    def monte_carlo_tree(self) -> MonteCarloTree:
+        """Return the Monte Carlo tree, allocated on the first use and then reused."""
+        if self.tree is None or self.tree.capacity != self.tree_nodes:
+            self.tree = MonteCarloTree(self.size, self.tree_nodes)
+
+        return self.tree
+
+    @contextmanager
+    def time_limit(self, end: float) -> Iterator[None]:
+        """Make the move generation raise `SearchTimeout` after the deadline."""
+        previous = self.deadline
+        self.deadline = end
+        try:
+            yield
+        finally:
+            self.deadline = previous
+
+    def check_deadline(self) -> None:
+        """Raise `SearchTimeout` if the deadline of the move generation passed."""
+        if time.perf_counter() > self.deadline:
+            raise SearchTimeout
+
+    def recover_from_interrupt(self) -> None:
+        """
+        Restore the inner state after the watchdog interrupted the previous move.
+
+        The interrupt could have hit in the middle of playing or reversing a move
+        or of storing an entry, so everything derived from the board is dropped.
+        The board itself is reloaded at the start of every move anyway and the
+        reserves and move counters are restored right after the interrupt.
+        """
+        print("Recovering from the watchdog timeout of the previous move")
+
+        self.interrupted = False
+        self.__cached_pinned.clear()
+        self.table.clear()
+
+    def record_overrun(self, end: float) -> None:
+        """Record by how much the move exceeded the deadline of the search."""
+        overrun = time.perf_counter() - end
+
+        if overrun <= 0:
+            return
+
+        self.overruns += 1
+        self.max_overrun = max(self.max_overrun, overrun)
+
+        print(
+            f"Overrun: {overrun * 1000:.1f} ms ({self.overruns} overruns,",
+            f"max {self.max_overrun * 1000:.1f} ms,",
+            f"{self.watchdog_timeouts} watchdog timeouts)",
+        )
+
+    def print_statistics(self, result: SearchResult, search: Search) -> None:
+        """Print the statistics of the search and the caches and reset them."""
+        global evaluated, cache_hits, updates, removed
+        print(
+            f"Searched to depth {result.depth} ({search.nodes} nodes,",
+            f"{evaluated} pos): {result.score}",
+        )
+        evaluated = 0
+
+        print(f"Cutoffs: {search.first_cutoffs} on first move of {search.cutoffs}")
+        print(f"Re-searches: {search.researches}")
+        print(f"Repetitions: {search.repetitions}")
+
+        clock = search.clock
+        duration = time.perf_counter() - clock.start
+        print(
+            f"Time: {duration:.3f} s ({search.nodes / duration:.0f} nodes/s),",
+            f"stopped on {clock.reason}",
+        )
+        print(
+            f"Selectivity {search.selectivity.name}: null move cutoffs:",
+            f"{search.null_cutoffs}, reductions: {search.reductions},",
+            f"root pruned: {search.root_pruned}",
+        )
+        print(f"Quiescence nodes: {search.quiescence_nodes}")
+
+        table = self.table
+        print(f"Table hits: {table.hits} of {table.probes} ({len(table)} stored)")
+
+        print(f"Cache size: {len(self.__cached_pinned)}")
+        print(f"Cache hits: {cache_hits} of {updates}")
+
+        print(f"Removed: {removed}")
+
+    def canonical_position(self) -> tuple[str, Symmetry, Cell]:
+        """
+        Return a key of the position, same for all of its symmetric variants.
+
+        The board is mapped by each of the symmetries and shifted, so that its
+        smallest cell is at the origin. The smallest of their descriptions makes
+        the key, together with the player to move and both reserves. Returns also
+        the chosen symmetry and the origin, to map the moves to the key's
+        coordinates and back.
+        """
+        best: tuple[str, Symmetry, Cell] | None = None
+
+        for symmetry in SYMMETRIES:
+            cells = sorted(
+                (apply_symmetry(symmetry, cell), pieces)
+                for cell, pieces in self._board.items()
+            )
+            origin_p, origin_q = origin = cells[0][0] if cells else (0, 0)
+
+            board = ";".join(
+                f"{p - origin_p},{q - origin_q}" + "".join(map(str, pieces))
+                for (p, q), pieces in cells
+            )
+
+            if best is None or board < best[0]:
+                best = board, symmetry, origin
+
+        assert best is not None
+
+        board, symmetry, origin = best
+        reserves = "".join(
+            f"{piece}{count}"
+            for piece, count in chain(
+                sorted(self.myPieces.items()),
+                sorted(self.rivalPieces.items()),
+            )
+        )
+
+        side = "U" if self.upper else "L"
+
+        return f"{side}{reserves}|{board}", symmetry, origin
+
+    def start_workers(self, count: int, *, ponder: bool = False) -> None:
+        """
+        Start a pool of worker processes for the parallel search.
+
+        The processes are started right away, so that the first searched move
+        doesn't pay for their startup. The player and all of the workers switch
+        to a single table in shared memory. With `ponder`, one of the workers
+        keeps searching during the rival's turn.
+        """
+        self.stop_workers()
+
+        table = SharedTranspositionTable(self.size)
+        stop = RawArray("b", 1)
+
+        self.workers = count
+        self.table = table
+        self.stop = stop
+        self.ponder = ponder
+        self.pool = Pool(count, init_worker, (self.size, table, stop))
+        self.pool.map(warm_up_worker, range(count))
+
+    def stop_workers(self) -> None:
+        """Stop the worker processes and switch back to the serial search."""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+
+        self.workers = 0
+        self.table = TranspositionTable()
+        self.pool = None
+        self.stop = None
+        self.ponder = False
+        self.pondering = None
+
+    def pondering_replies(self, move: Move) -> list[Move]:
+        """
+        Return the rival's replies to my move, to be searched by pondering.
+
+        Empty unless the pondering is enabled and the next search can use
+        the table, see `start_pondering`.
+        """
+        if not self.ponder or self.engine == Engine.MONTE_CARLO or self.deterministic:
+            return []
 
-            self.score, self.state = self.evaluate_children()
+        with play_move(self, move):
+            return list(self.moves_of(not self.upper))
 
-        return True
+    def start_pondering(self, move: Move, replies: list[Move]) -> None:
+        """
+        Search the position after my move in a worker, until the rival replies.
 
-    def evaluate_children(self) -> tuple[int, State]:
-        """Evaluate the children of the current node."""
-        if not self.children:
-            return 0, State.DRAW
+        The worker searches all of the given replies (see `pondering_replies`)
+        as if it was the rival. The results end up in the shared table, where
+        the next search finds the ones for the reply that was actually played.
+        """
+        if not replies:
+            return
 
-        children = self.children
+        assert self.pool is not None
+
+        brute = move.to_brute(self.upper)
+        my_pieces = self.myPieces.copy()
+
+        if move.start is None:
+            my_pieces[brute[0]] -= 1
+
+        task = WorkerTask(
+            self.size,
+            not self.upper,
+            play_brute_move(self.board, brute),
+            self.rivalPieces,
+            my_pieces,
+            self.rival_move,
+            not self.rival_started,
+            list(self.game_positions),
+            self.selectivity,
+            [reply.to_brute(not self.upper) for reply in replies],
+            PONDER_BUDGET,
+        )
 
-        children.sort(reverse=True)
+        self.pondering = self.pool.apply_async(search_worker, (task,))
 
-        depth = self.depth
-        if depth <= 2:
-            limit = 8
-        elif depth <= 3:
-            limit = 5
-        elif depth <= 5:
-            limit = 3
-        else:
-            limit = 2
+    def stop_pondering(self) -> SearchResult | None:
+        """Stop the pondering worker and return its result, if it was pondering."""
+        if self.pondering is None:
+            return None
 
-        self.children = children[:limit]
+        assert self.stop is not None
 
-        best = self.children[0]
+        self.stop[0] = 1
+        self.pondering.wait(PONDER_STOP_TIMEOUT)
+        self.stop[0] = 0
 
-        return -best.score, best.state.inverse()
+        pondering, self.pondering = self.pondering, None
 
-    def __gt__(self, other: Node) -> bool:
-        """Compare nodes by score."""
-        return self.score > other.score
+        if not pondering.ready():
+            print("Pondering didn't stop in time, restarting the workers")
+            self.start_workers(self.workers, ponder=self.ponder)
+            return None
 
-    def __str__(self) -> str:
-        """Return a string representation of the node."""
-        if self.state.is_end():
-            return f"{self.move}: {self.score} {self.state}"
+        if not pondering.successful():
+            return None
 
-        return f"{self.move}: {self.score}"
+        move, score, state, depth, line = pondering.get()
+        reply = Move.from_brute(move)
 
+        print(f"Pondered to depth {depth}, expected reply: {reply}")
 
-@contextmanager
-def lift_piece(player: Player, cell: Cell) -> Iterator[Piece]:
-    """Lifts a piece from the board for the duration of the context."""
-    piece = player.remove_piece_from_board(cell)
-    yield piece
-    player.add_piece_to_board(cell, piece)
+        return SearchResult(
+            reply, score, state, depth, list(map(Move.from_brute, line))
+        )
 
+    def parallel_minimax(self, moves: list[Move], end: float) -> SearchResult:
+        """
+        Split the root moves between the workers and search them in parallel.
 
-@contextmanager
-def play_move(player: Player, move: Move) -> Iterator[None]:
-    """Plays a move for the duration of the context."""
-    player.play_move(move)
-    yield
-    player.reverse_move(move)
+        Each worker runs its own iterative deepening over its share of the moves,
+        the best of the results that arrive before the deadline is returned.
+        """
+        assert self.pool is not None
+
+        budget = end - time.perf_counter()
+        shares = [moves[i :: self.workers] for i in range(self.workers)]
+
+        pending = [
+            self.pool.apply_async(
+                search_worker,
+                (
+                    WorkerTask(
+                        self.size,
+                        self.upper,
+                        self.board,
+                        self.myPieces,
+                        self.rivalPieces,
+                        self.myMove,
+                        self.rival_started,
+                        list(self.game_positions),
+                        self.selectivity,
+                        [move.to_brute(self.upper) for move in share],
+                        budget,
+                    ),
+                ),
+            )
+            for share in shares
+            if share
+        ]
 
+        best = SearchResult(moves[0], -INFINITY, State.RUNNING, 0, [moves[0]])
 
-class Player(Board):
-    """
-    A player for the hive game. Public API includes the constructor and the move method.
+        for task in pending:
+            task.wait(max(end - time.perf_counter(), 0))
 
-    ## State:
-    Inner state consists of a set of cells that together create the hive. This is done
-    in order to speed up lot of the calculations inside and thus all of the methods
-    implicitly depends on it. The properties should be independent and stateless,
-    unless explicitly specified otherwise in their docstrings.
-    """
+            if not task.ready() or not task.successful():
+                continue
 
-    __slots__ = (
-        "__board",
-        "cycles",
-        "__cached_cycles",
-        "__cycles_need_update",
-        "size",
-        "myColorIsUpper",
-        "myPieces",
-        "rivalPieces",
-        "playerName",
-        "algorithmName",
-    )
+            move, score, state, depth, line = task.get()
+
+            # prefer the fastest win, but otherwise the most reliable result
+            if (score, -depth if state == State.WIN else depth) > (
+                best.score,
+                -best.depth if best.state == State.WIN else best.depth,
+            ):
+                best = SearchResult(
+                    Move.from_brute(move),
+                    score,
+                    state,
+                    depth,
+                    list(map(Move.from_brute, line)),
+                )
+                self.fallback = best.move
 
-    _board: BoardData
-    cycles: set[Cell]
-    __cached_cycles: dict[int, set[Cell]]
-    __cycles_need_update: bool
+        return best
 
-    def __init__(
+    def minimax(
         self,
-        player_name: str,
-        my_is_upper: bool,
-        size: int,
-        my_pieces: dict[str, int],
-        rival_pieces: dict[str, int],
-    ) -> None:
+        moves: list[Move],
+        end: float,
+        *,
+        multi_pv: int = 1,
+    ) -> tuple[SearchResult, Search]:
         """
-        Create a new player.
+        Run iterative deepening alpha-beta search over the given moves.
 
-        *Note: the API has to stay this way to be compatible with Brute*
+        Returns the result for the best move, with the deepest fully searched
+        depth, and the search itself, for its statistics. Result of an unfinished
+        iteration is used only if it already searched the previous best move, which
+        is always searched first.
+
+        Every iteration after the first one starts with an aspiration window
+        around the score of the previous one.
+
+        The table is kept between the moves, so when the position was already
+        searched during my previous move (as the expected reply) or while
+        pondering, the iterations resume right at the stored depth, with the stored
+        move first. Only a quick iteration at depth 1 precedes them, so that there
+        is a result even when the resumed iteration doesn't finish.
+
+        The search stops as soon as the `TimeManager` predicts that the next
+        iteration couldn't change the result, or when only one move is left.
+        Independently of the time, it stops after `Player.depth_limit` and
+        `Player.node_limit`.
+
+        With `multi_pv`, that many best moves are kept in every iteration and get
+        exact scores, ranked in `Search.ranking`.
         """
-        super().__init__(my_is_upper, size, my_pieces, rival_pieces)
-        self.playerName = player_name
-        self.algorithmName = "Maneren v1.1"
-        self._board = convert_board(self.board)
-        self.cycles = set()
-        self.__cached_cycles = {}
-        self.__cycles_need_update = True
+        search = Search(self, end)
+        search.multi_pv = multi_pv
+        clock = search.clock
 
-    @property
-    def upper(self) -> bool:
-        """The player uses uppercased pieces."""
-        return self.myColorIsUpper
+        best = moves[0]
+        score = -INFINITY
+        state = State.RUNNING
+        depth = 0
 
-    @property
-    def cells(self) -> Iterator[Cell]:
-        """Iterator over all cells."""
-        return (
-            (p, q)
-            for q in range(self.size)
-            for p in range(-(q // 2), self.size - q // 2)
-        )
+        moves, first_depth, expected = self.resume_point(moves)
+        stored = moves[0]
+        depths = list(range(first_depth, self.depth_limit + 1))
 
-    @property
-    def empty_cells(self) -> Iterator[Cell]:
-        """Iterator over all empty cells."""
-        return (cell for cell in self.cells if self.is_empty(cell))
+        if first_depth > 1:
+            depths.insert(0, 1)
 
-    @property
-    def nonempty_cells(self) -> Iterator[Cell]:
-        """Iterator over all nonempty cells."""
-        return iter(self._board.keys())
+        for next_depth in depths:
+            if depth and not clock.should_continue():
+                break
 
-    @property
-    def my_pieces_on_board(self) -> Iterator[tuple[Cell, Piece]]:
-        """Iterator over all my pieces on the board."""
-        board_contents = [
-            (cell, pieces)
-            for cell, pieces in self._board.items()
-            if self.is_my_cell(cell)
-        ]
-        return ((cell, pieces[-1]) for cell, pieces in board_contents)
+            iteration_start = time.perf_counter()
+            guess = (
+                expected if next_depth == first_depth else (score if depth else None)
+            )
 
-    @property
-    def my_placable_pieces(self) -> Iterator[PieceKind]:
-        """Iterator over all my placable pieces."""
-        return (
-            PieceKind.from_str(piece)
-            for piece, count in self.myPieces.items()
-            if count > 0
-        )
+            try:
+                search.aspiration(moves, next_depth, guess)
+            except SearchTimeout:
+                clock.reason = (
+                    "node limit" if search.nodes > search.node_limit else "timeout"
+                )
 
-    @property
-    def my_movable_pieces(self) -> Iterator[tuple[Cell, Piece]]:
-        """Iterator over all my movable pieces."""
-        return (
-            (cell, piece)
-            for cell, piece in self.my_pieces_on_board
-            if not self.moving_breaks_hive(cell)
-        )
+                if search.best_move is not None:
+                    best, score = search.best_move, search.best_score
+                    state = search.best_state
+                break
 
-    @property
-    def valid_placements(self) -> Iterator[Cell]:
-        """
-        Iterator over all valid placements.
+            assert search.best_move is not None
 
-        Expects at least one piece to be already placed
-        """
-        return (
-            cell
-            for cell in self.cells_around_hive
-            if self.neighbors_only_my_pieces(cell)
-        )
+            best, score, depth = search.best_move, search.best_score, next_depth
+            state = search.best_state
+            self.fallback = best
 
-    @property
-    def valid_moves(self) -> Iterator[Move]:
-        """Iterator over all valid moves."""
-        mapping = {
-            PieceKind.Ant: self.ants_moves,
-            PieceKind.Queen: self.queens_moves,
-            PieceKind.Beetle: self.beetles_moves,
-            PieceKind.Grasshopper: self.grasshoppers_moves,
-            PieceKind.Spider: self.spiders_moves,
-        }
+            # the quick iteration before resuming would spoil the predicted growth
+            if next_depth >= first_depth:
+                clock.record(time.perf_counter() - iteration_start, len(moves), best)
 
-        if self.myMove == 1:
-            return map(
-                functools.partial(Move, PieceKind.Queen, None),
-                self.valid_placements,
-            )
+            # search the best moves first in the next iteration
+            results = sorted(search.results, key=lambda result: result[1], reverse=True)
+            search.ranking = results
 
-        if 2 <= self.myMove <= 3:
-            return map(
-                functools.partial(Move, PieceKind.Ant, None),
-                self.valid_placements,
-            )
+            if search.best_state.is_end():
+                clock.reason = "game end"
+                break
 
-        place_iter = (
-            Move(piece, None, cell)
-            for cell, piece in product(self.valid_placements, self.my_placable_pieces)
-        )
+            width = self.selectivity.root_width(next_depth)
+            limit = len(moves) if width is None else max(width, multi_pv)
 
-        move_iter = (
-            move
-            for cell, piece in self.my_movable_pieces
-            for move in mapping[piece.kind](cell)
-        )
+            moves = [move for move, _, state in results if state != State.LOSS]
+            search.root_pruned += max(len(moves) - limit, 0)
+            moves = moves[:limit]
 
-        return chain(place_iter, move_iter) if self.myMove >= 4 else place_iter
+            if len(moves) <= 1:
+                clock.reason = "forced move"
+                break
 
-    @property
-    def cells_around_hive(self) -> set[Cell]:
-        """Set of all cells around the hive."""
-        return {
-            neighbor
-            for cell in self._board
-            for neighbor in self.empty_neighboring_cells(cell)
-        }
+            if next_depth < first_depth:
+                # resume with the stored move first, as it was searched the deepest
+                moves = [stored, *(move for move in moves if move != stored)]
 
-    def move(self) -> MoveBrute:
-        """
-        Return a best move for the current self.board.
+        line = self.principal_line(best, depth)
 
-        Has to first properly initialize self._board.
+        return SearchResult(best, score, state, depth, line), search
 
-        Format:
-            [piece, oldP, oldQ, newP, newQ] - move from (oldP, oldQ) to (newP, newQ)
-            [piece, None, None, newP, newQ] - place new at (newP, newQ)
-            [] - no move is possible
+    def resume_point(self, moves: list[Move]) -> tuple[list[Move], int, int | None]:
+        """
+        Return the root moves, the depth to resume at and the expected score.
 
-        *Note: the API has to stay this way to be compatible with Brute*
+        When the table has an entry for the current position, its move goes first
+        and its depth and exact score are used, otherwise the search starts anew.
         """
-        end = time.perf_counter() + 0.95
+        entry = self.table.probe(self.zobrist)
 
-        self._board = convert_board(self.board)
-        self.__cycles_need_update = True
+        if entry is None or entry.move not in moves:
+            return moves, 1, None
 
-        if self.myMove == 0:
-            if not self._board:
-                return Move(PieceKind.Spider, None, (3, 6)).to_brute(self.upper)
+        moves = [entry.move, *(move for move in moves if move != entry.move)]
+        self.fallback = entry.move
+        expected = entry.score if entry.bound == Bound.EXACT else None
 
-            placement = choice(list(self.cells_around_hive))
-            return Move(PieceKind.Spider, None, placement).to_brute(self.upper)
+        return moves, min(max(entry.depth, 1), self.depth_limit), expected
 
-        if TEST or not self.tournament:
-            possible_moves = list(self.valid_moves)
-            return choice(possible_moves).to_brute(self.upper) if possible_moves else []
+    def analyse(self, end: float, count: int) -> list[SearchResult]:
+        """
+        Return up to `count` best moves in the current position, the best first.
 
-        nodes = [Node(move, self) for move in self.valid_moves]
+        All of them come from a single search (see `minimax`), each with its own
+        exact score and principal variation, to the depth of the last finished
+        iteration.
+        """
+        moves = list(self.valid_moves)
 
-        if not nodes:
+        if not moves:
             return []
 
-        best, depth = self.minimax(nodes, end)
-
-        global evaluated, cache_hits, updates, found_cycles, duplicates, removed
-        print(f"Searched to depth {depth} ({evaluated} pos): {best.score}")
-        evaluated = 0
+        result, search = self.minimax(moves, end, multi_pv=count)
 
-        print(f"Cache size: {len(self.__cached_cycles)}")
-        print(f"Cache hits: {cache_hits} of {updates}")
+        if not search.ranking:
+            return [result]
 
-        print(f"Found cycles: {found_cycles}")
-        print(f"Duplicates: {duplicates}")
+        return [
+            SearchResult(
+                move,
+                score,
+                state,
+                result.depth,
+                self.principal_line(move, result.depth),
+            )
+            for move, score, state in search.ranking[:count]
+        ]
 
-        print(f"Removed: {removed}")
+    def principal_line(self, move: Move, depth: int) -> list[Move]:
+        """
+        Return the expected continuation after my move, up to the given depth.
 
-        return best.move.to_brute(self.upper)
+        The moves are followed through the transposition table, so the line ends
+        early where the table doesn't hold the position anymore.
+        """
+        line = [move]
+        upper = self.upper
 
-    def minimax(self, nodes: list[Node], end: float) -> tuple[Node, int]:
-        """Run the minimax algorithm on the list of nodes return the best move."""
-        best = nodes[0]
+        with ExitStack() as stack:
+            stack.enter_context(play_move(self, move, upper))
 
-        depth = 0
-        for depth in count():
-            if time.perf_counter() > end:
-                break
+            while len(line) < depth:
+                upper = not upper
+                entry = self.table.probe(self.zobrist)
 
-            for node in nodes:
-                if not node.next_depth(self, end, target_player=self.upper):
-                    return max(nodes), depth
+                if entry is None or entry.move is None:
+                    break
 
-            if depth <= 2:
-                limit = len(nodes)
-            elif depth <= 5:
-                limit = 5
-            else:
-                limit = 2
+                if not self.is_plausible(entry.move, upper):
+                    break
 
-            win_moves = (node for node in nodes if node.state == State.WIN)
+                line.append(entry.move)
+                stack.enter_context(play_move(self, entry.move, upper))
 
-            win = next(win_moves, None)
+        return line
 
-            if win:
-                return win, depth
+    def is_plausible(self, move: Move, upper: bool) -> bool:
+        """
+        Quickly check if the given player could make the move.
 
-            nodes.sort(reverse=True)
+        Checks only that the player has the piece in the start cell or in
+        the reserve, not that the move is valid.
+        """
+        piece = PIECES[move.piece][upper]
 
-            nodes = list(
-                islice((node for node in nodes if node.state != State.LOSS), limit),
-            )
+        if move.start is None:
+            return self.pieces_in_reserve(upper).get(piece.char, 0) > 0
 
-            if not nodes:
-                break
+        return self.isnt_empty(move.start) and self.top_piece_in(move.start) == piece
 
-            best = max(nodes)
+    def piece_moves(self, cell: Cell, kind: PieceKind) -> Iterator[Move]:
+        """Return an iterator over all valid moves of the piece in the given cell."""
+        mapping = {
+            PieceKind.Ant: self.ants_moves,
+            PieceKind.Queen: self.queens_moves,
+            PieceKind.Beetle: self.beetles_moves,
+            PieceKind.Grasshopper: self.grasshoppers_moves,
+            PieceKind.Spider: self.spiders_moves,
+        }
 
-        return best, depth
+        return mapping[kind](cell)
 
     def moving_breaks_hive(self, cell: Cell) -> bool:
         """Check if moving the given piece breaks the hive into parts."""
         if len(self[cell]) > 1:
             return False
 
-        neighbor_groups = self.neighbor_groups(cell)
-
-        if neighbor_groups == 1:
+        # a single group of neighbors stays connected around the empty cell
+        if self.neighbor_groups(cell) == 1:
             return False
 
-        in_cycle = self.is_in_cycle(cell)
-
-        return neighbor_groups != 2 if in_cycle else True
+        return self.is_pinned(cell)
 
     def queens_moves(self, queen: Cell) -> Iterator[Move]:
         """
@@ -791,6 +3717,7 @@ class Player(Board):
             queue = deque(next_cells(ant))
 
             while queue:
+                self.check_deadline()
                 current = queue.popleft()
                 if current in visited:
                     continue
@@ -828,20 +3755,23 @@ class Player(Board):
 
             move = functools.partial(Move, PieceKind.Grasshopper, grasshopper)
 
+            tables = self.tables
+
             # for each direction
-            for dp, dq in DIRECTIONS:
+            for direction in range(len(DIRECTIONS)):
                 # start at grasshopper's position
-                current_cell = grasshopper
+                current = tables.cell_index[grasshopper]
                 skipped = False
 
                 # move in that direction until edge of board
                 while True:
-                    p, q = current_cell
-                    current_cell = (p + dp, q + dq)
+                    current = tables.neighbor_indices[6 * current + direction]
 
-                    if not self.in_board(current_cell):
+                    if current < 0:
                         break
 
+                    current_cell = tables.cells[current]
+
                     # if tile is empty and
                     # if something was skipped, yield move
                     # else try different direction
@@ -894,15 +3824,17 @@ class Player(Board):
 
     def neighboring_cells(self, cell: Cell) -> Iterator[Cell]:
         """Return an iterator over all cells neighboring (p,q)."""
-        return filter(self.in_board, self.neighboring_cells_unchecked(cell))
+        return iter(self.tables.neighbor_cells[cell])
 
     def empty_neighboring_cells(self, cell: Cell) -> Iterator[Cell]:
         """Return an iterator over all cells neighboring (p,q) that are empty."""
-        return filter(self.is_empty, self.neighboring_cells(cell))
+        layout = self.layout
+        return layout.cells(layout.neighbor_masks[cell] & ~self.occupancy)
 
     def neighbors(self, cell: Cell) -> Iterator[Cell]:
         """Return an iterator over all cells neighboring (p,q) that aren't empty."""
-        return filter(self.isnt_empty, self.neighboring_cells_unchecked(cell))
+        layout = self.layout
+        return layout.cells(layout.neighbor_masks[cell] & self.occupancy)
 
     def valid_steps(
         self,
@@ -927,145 +3859,103 @@ class Player(Board):
 
     def neighbor_groups(self, cell: Cell) -> int:
         """Return the number of groups around the given cell."""
-        neighbors = self.neighboring_cells_unchecked(cell)
-        first = next(neighbors)
-
-        groups = 0
-        in_group = first in self._board
+        return NEIGHBOR_GROUPS[self.layout.ring(self.occupancy, cell)]
 
-        for neighbor in neighbors:
-            if neighbor in self._board:
-                in_group = True
-            elif in_group:
-                in_group = False
-                groups += 1
-
-        if in_group and first not in self._board:
-            groups += 1
-
-        return groups
-
-    def update_cycles(self) -> None:
+    def update_pinned(self) -> None:
         """
-        Find all cycles in the hive.
+        Find all pieces pinned by the one hive rule.
 
-        Runs a DFS from the given cell marking the cells visited. When already
-        cell is encountered second time, a cycle is detected. If the length of the cycle
-        is more than 2 (trio of neighboring cells), the cycle is returned.
+        The pinned pieces are the articulation points of the graph of the occupied
+        cells, found by an iterative Tarjan's DFS. A cell is an articulation point
+        if some of its DFS subtrees can't reach above it without passing through it.
+        The result depends only on the occupied cells, not on the order of the board.
         """
+        global updates, cache_hits
+        updates += 1
 
-        def collect_path(
-            cell: Cell, visited_from: dict[Cell, Cell | None]
-        ) -> list[Cell]:
-            """Collect a path from the given cell."""
-            path = [cell]
-
-            while path[-1] in visited_from:
-                new = visited_from[path[-1]]
-                if not new:
-                    break
-                path.append(new)
-
-            return path
-
-        def find_cycle(start: Cell) -> set[Cell] | None:
-            """Try find a cycle in the hive."""
-            stack = [start]
-
-            visited_from: dict[Cell, Cell | None] = {start: None}
-
-            while stack:
-                new_stack = []
-
-                for cell in stack:
-                    for neighbor in self.neighbors(cell):
-                        if neighbor not in visited_from:
-                            new_stack.append(neighbor)
-                            visited_from[neighbor] = cell
-                            continue
-
-                        cell_visited_from = visited_from[cell]
-
-                        if not cell_visited_from or cell_visited_from == neighbor:
-                            continue
-
-                        part1 = collect_path(neighbor, visited_from)
-                        part2 = collect_path(cell, visited_from)
-
-                        last = None
-
-                        while part1[-1] == part2[-1]:
-                            part1.pop()
-                            last = part2.pop()
+        # the pinned pieces depend only on which cells are occupied
+        cached = self.__cached_pinned.get(self.occupancy)
 
-                        if last:
-                            part2.append(last)
+        if cached is not None:
+            cache_hits += 1
+            self.pinned = cached
+            self.__pinned_need_update = False
+            return
 
-                        result = set(part1 + part2)
+        self.check_deadline()
 
-                        return result if len(result) > 3 else None
+        pinned: set[Cell] = set()
+        depth: dict[Cell, int] = {}
+        low: dict[Cell, int] = {}
 
-                stack = new_stack
+        for root in self._board:
+            if root in depth:
+                continue
 
-            return None
+            depth[root] = low[root] = 0
+            root_children = 0
+            stack = [(root, root, self.neighbors(root))]
 
-        if len(self._board) <= 6:
-            return
+            while stack:
+                cell, parent, neighbors = stack[-1]
 
-        self.__cycles_need_update = False
+                for neighbor in neighbors:
+                    if neighbor not in depth:
+                        depth[neighbor] = low[neighbor] = depth[cell] + 1
+                        stack.append((neighbor, cell, self.neighbors(neighbor)))
+                        break
 
-        hashed = 0
-        for cell in self._board:
-            for n in cell:
-                hashed <<= 5
-                hashed ^= n
-                hashed *= 0x27220A95
-                hashed %= 2**32
+                    if neighbor != parent:
+                        low[cell] = min(low[cell], depth[neighbor])
+                else:
+                    stack.pop()
 
-        global updates, cache_hits, found_cycles, duplicates
-        updates += 1
+                    if cell == root:
+                        continue
 
-        if hashed in self.__cached_cycles:
-            cache_hits += 1
-            self.cycles = self.__cached_cycles[hashed]
-            return
+                    low[parent] = min(low[parent], low[cell])
 
-        self.cycles.clear()
+                    if parent == root:
+                        root_children += 1
+                    elif low[cell] >= depth[parent]:
+                        pinned.add(parent)
 
-        for cell in self._board:
-            if cell in self.cycles:
-                continue
+            if root_children > 1:
+                pinned.add(root)
 
-            cycle = find_cycle(cell)
+        self.pinned = pinned
+        self.__cached_pinned[self.occupancy] = pinned
+        self.__pinned_need_update = False
 
-            if not cycle:
-                continue
+    def is_pinned(self, cell: Cell) -> bool:
+        """Check if removing the cell splits the hive."""
+        if self.__pinned_need_update:
+            self.update_pinned()
+        return cell in self.pinned
 
-            found_cycles += 1
+    def game_state(self, target_player: bool) -> State:
+        """Return the state of the game from the POV of the target player."""
+        my_queen_surrounded = False
+        rivals_queen_surrounded = False
 
-            if cycle <= self.cycles:
-                duplicates += 1
+        for cell, upper in self.queens:
+            if length_of_iter(self.neighbors(cell)) < 6:
                 continue
 
-            self.cycles.update(cycle)
+            if upper == target_player:
+                my_queen_surrounded = True
+            else:
+                rivals_queen_surrounded = True
 
-        self.__cached_cycles[hashed] = self.cycles
+        if my_queen_surrounded:
+            return State.DRAW if rivals_queen_surrounded else State.LOSS
 
-    def is_in_cycle(self, cell: Cell) -> bool:
-        """Check if cell is in a cycle."""
-        if self.__cycles_need_update:
-            self.update_cycles()
-        return cell in self.cycles
+        return State.WIN if rivals_queen_surrounded else State.RUNNING
 
     def top_piece_in(self, cell: Cell) -> Piece:
         """Return the top piece in given cell."""
         return self[cell][-1]
 
-    def my_piece_remaining(self, piece: PieceKind) -> int:
-        """Return the number of my pieces of given type."""
-        piece_str = piece.upper() if self.upper else piece.lower()
-        return self.myPieces[piece_str]
-
     def is_my_cell(self, cell: Cell) -> bool:
         """Check if (p,q) is a cell owned by the player."""
         return self[cell][-1].upper == self.upper
@@ -1084,12 +3974,13 @@ class Player(Board):
 
     def in_board(self, cell: Cell) -> bool:
         """Check if (p,q) is a valid coordinate within the board."""
-        p, q = cell
-        return 0 <= q < self.size and 0 <= p + q // 2 < self.size
+        return cell in self.tables.cell_index
 
-    def neighbors_only_my_pieces(self, cell: Cell) -> bool:
-        """Check if all neighbors of (p,q) are owned by the player."""
-        return all(map(self.is_my_cell, self.neighbors(cell)))
+    def neighbors_only_pieces_of(self, cell: Cell, upper: bool) -> bool:
+        """Check if all neighbors of (p,q) are owned by the given player."""
+        return all(
+            self.is_target_cell(neighbor, upper) for neighbor in self.neighbors(cell)
+        )
 
     def has_neighbor(self, cell: Cell) -> bool:
         """Check if (p,q) has a neighbor."""
@@ -1097,17 +3988,23 @@ class Player(Board):
 
     def has_neighbor_in_direction(self, cell: Cell, direction: Direction) -> bool:
         """Check if (p,q) has a neighbors in given direction."""
-        p, q = cell
-        dp, dq = direction
+        return self.has_neighbor_at(cell, DIRECTION_INDEX[direction])
 
-        lp, lq = rotate_left(direction)
-        rp, rq = rotate_right(direction)
+    def has_neighbor_at(self, cell: Cell, direction: int) -> bool:
+        """Check if (p,q) has a neighbor in the direction or the ones next to it."""
+        tables = self.tables
+        base = 6 * tables.cell_index[cell]
+        neighbors = tables.neighbor_indices
+        occupancy = self.occupancy
+        cell_masks = self.layout.cell_masks
 
-        left = (p + lp, q + lq)
-        right = (p + rp, q + rq)
-        center = p + dp, q + dq
+        for offset in (-1, 0, 1):
+            neighbor = neighbors[base + (direction + offset) % 6]
 
-        return not all(map(self.is_empty, [left, right, center]))
+            if neighbor >= 0 and occupancy & cell_masks[tables.cells[neighbor]]:
+                return True
+
+        return False
 
     def can_move_to(
         self,
@@ -1126,16 +4023,16 @@ class Player(Board):
         p, q = origin
         np, nq = target
 
-        direction = (np - p, nq - q)
+        tables = self.tables
+        direction = DIRECTION_INDEX[np - p, nq - q]
+        base = 6 * tables.cell_index[origin]
 
-        lp, lq = rotate_left(direction)
-        rp, rq = rotate_right(direction)
+        # the two cells next to both the origin and the target
+        left = tables.neighbor_indices[base + (direction - 1) % 6]
+        right = tables.neighbor_indices[base + (direction + 1) % 6]
 
-        left = (p + lp, q + lq)
-        right = (p + rp, q + rq)
-
-        left_empty = self.is_empty(left)
-        right_empty = self.is_empty(right)
+        left_empty = left < 0 or self.is_empty(tables.cells[left])
+        right_empty = right < 0 or self.is_empty(tables.cells[right])
 
         # one has to be empty and the other full
         return left_empty != right_empty or (
@@ -1143,31 +4040,59 @@ class Player(Board):
             left_empty
             and right_empty
             and can_leave_hive
-            and self.has_neighbor_in_direction(target, direction)
+            and self.has_neighbor_at(target, direction)
         )
 
     def remove_piece_from_board(self, cell: Cell) -> Piece:
         """Remove the top-most piece at the given cell and return it."""
         pieces = self._board[cell]
         piece = pieces.pop()
+        mask = self.layout.cell_masks[cell]
+
+        self.zobrist ^= self.keys.piece(cell, piece, len(pieces))
+        self.colors[piece.upper] &= ~mask
+        self.placed[piece.index] -= 1
 
-        if not pieces:
+        if all(other.kind != piece.kind for other in pieces):
+            self.kinds[piece.kind] &= ~mask
+
+        if piece.kind == PieceKind.Queen:
+            self.queen_cells[piece.upper] = self.find_queen(piece.upper)
+
+        if pieces:
+            self.colors[pieces[-1].upper] |= mask
+        else:
             self._board.pop(cell, None)
-            self.__cycles_need_update = True
+            self.occupancy &= ~mask
+            self.__pinned_need_update = True
 
         return piece
 
     def add_piece_to_board(self, cell: Cell, piece: Piece) -> None:
         """Place the given piece at the given cell."""
-        if cell not in self._board:
+        pieces = self._board.get(cell)
+        mask = self.layout.cell_masks[cell]
+
+        if pieces is None:
             self._board[cell] = [piece]
-            self.__cycles_need_update = True
+            self.occupancy |= mask
+            self.__pinned_need_update = True
+            self.zobrist ^= self.keys.piece(cell, piece, 0)
         else:
-            self[cell].append(piece)
+            self.zobrist ^= self.keys.piece(cell, piece, len(pieces))
+            self.colors[pieces[-1].upper] &= ~mask
+            pieces.append(piece)
+
+        self.colors[piece.upper] |= mask
+        self.kinds[piece.kind] |= mask
+        self.placed[piece.index] += 1
 
-    def play_move(self, move: Move) -> None:
-        """Play the given move."""
-        piece = Piece(move.piece, self.upper)
+        if piece.kind == PieceKind.Queen:
+            self.queen_cells[piece.upper] = cell
+
+    def play_move(self, move: Move, upper: bool) -> None:
+        """Play the given move for the given player."""
+        piece = PIECES[move.piece][upper]
         start = move.start
         end = move.end
 
@@ -1176,14 +4101,21 @@ class Player(Board):
             removed = self.remove_piece_from_board(start)
             assert removed == piece
         else:
-            self.myPieces[str(piece)] -= 1
+            self.pieces_in_reserve(upper)[piece.char] -= 1
+
+        if upper == self.upper:
+            self.myMove += 1
+        else:
+            self.rival_move += 1
 
         # add the piece to its new position
         self.add_piece_to_board(end, piece)
 
-    def reverse_move(self, move: Move) -> None:
-        """Reverse the given move."""
-        piece = Piece(move.piece, self.upper)
+        self.zobrist ^= self.keys.side
+
+    def reverse_move(self, move: Move, upper: bool) -> None:
+        """Reverse the given move of the given player."""
+        piece = PIECES[move.piece][upper]
         start = move.start
         end = move.end
 
@@ -1191,17 +4123,90 @@ class Player(Board):
             # add the piece back to its old position
             self.add_piece_to_board(start, piece)
         else:
-            self.myPieces[str(piece)] += 1
+            self.pieces_in_reserve(upper)[piece.char] += 1
+
+        if upper == self.upper:
+            self.myMove -= 1
+        else:
+            self.rival_move -= 1
 
         # remove the piece from its new position
         removed = self.remove_piece_from_board(end)
         assert removed == piece
 
+        self.zobrist ^= self.keys.side
+
+    def load_board(self) -> None:
+        """
+        Convert `self.board` to the inner representation and hash it.
+
+        Also determines the index of the next rival's move, which depends on who
+        started the game. That is known only on my first move.
+        """
+        self._board = convert_board(self.board)
+        self.__pinned_need_update = True
+
+        if self.myMove == 0:
+            self.rival_started = bool(self._board)
+
+        self.rival_move = self.myMove + self.rival_started
+
+        self.zobrist = 0
+        self.occupancy = 0
+        self.colors = [0, 0]
+        self.kinds = {kind: 0 for kind in PieceKind}
+        self.queen_cells = [None, None]
+        self.placed = [0] * PIECE_COUNT
+
+        for cell, pieces in self._board.items():
+            self.zobrist ^= self.stack_key(cell, pieces)
+            self.mark_stack(cell, pieces)
+
+        if self.upper:
+            self.zobrist ^= self.keys.side
+
+    def mark_stack(self, cell: Cell, pieces: list[Piece]) -> None:
+        """Add the stack of pieces in the given cell to the bitboards and counts."""
+        mask = self.layout.cell_masks[cell]
+
+        self.occupancy |= mask
+        self.colors[pieces[-1].upper] |= mask
+
+        for piece in pieces:
+            self.kinds[piece.kind] |= mask
+            self.placed[piece.index] += 1
+
+            if piece.kind == PieceKind.Queen:
+                self.queen_cells[piece.upper] = cell
+
+    def unmark_cell(self, cell: Cell) -> None:
+        """Remove the stack in the given cell from all of the bitboards."""
+        mask = ~self.layout.cell_masks[cell]
+
+        self.occupancy &= mask
+        self.colors = [colors & mask for colors in self.colors]
+        self.kinds = {kind: cells & mask for kind, cells in self.kinds.items()}
+
+        for piece in self._board[cell]:
+            self.placed[piece.index] -= 1
+
+            if piece.kind == PieceKind.Queen:
+                self.queen_cells[piece.upper] = self.find_queen(piece.upper)
+
+    def stack_key(self, cell: Cell, pieces: list[Piece]) -> int:
+        """Return the Zobrist key of the given stack of pieces in the given cell."""
+        key = 0
+
+        for height, piece in enumerate(pieces):
+            key ^= self.keys.piece(cell, piece, height)
+
+        return key
+
     def set_board(self, board: BoardDataBrute) -> None:
         """Set the board to the given board."""
         self.board = board
-        self._board = convert_board(board)
-        self.update_cycles()
+        self.load_board()
+        self.update_pinned()
 
         base = {
             PieceKind.Queen: 1,
@@ -1226,13 +4231,11 @@ class Player(Board):
                 piece_kind.lower(): count for piece_kind, count in base.items()
             }
 
-        for value in self._board.values():
-            for piece in value:
-                piece_str = str(piece)
-                if piece_str in my_pieces:
-                    my_pieces[piece_str] -= 1
-                else:
-                    rival_pieces[piece_str] -= 1
+        for piece_str, piece in PIECE_CHARS.items():
+            if piece_str in my_pieces:
+                my_pieces[piece_str] -= self.placed[piece.index]
+            else:
+                rival_pieces[piece_str] -= self.placed[piece.index]
 
         self.myPieces = my_pieces
         self.rivalPieces = rival_pieces
@@ -1246,7 +4249,13 @@ class Player(Board):
     def __setitem__(self, cell: Cell, value: list[Piece]) -> None:
         """Set the list of pieces at the given cell."""
         if cell not in self._board:
-            self.__cycles_need_update = True
+            self.__pinned_need_update = True
+        else:
+            self.zobrist ^= self.stack_key(cell, self._board[cell])
+            self.unmark_cell(cell)
+
+        self.zobrist ^= self.stack_key(cell, value)
+        self.mark_stack(cell, value)
         self._board[cell] = value
 
     def __str__(self) -> str:
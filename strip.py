@@ -29,7 +29,7 @@ class TypeHintRemover(ast.NodeTransformer):
                 isinstance(statement, ast.Expr)
                 and isinstance(statement.value, ast.Constant)
             )
-        ]
+        ] or [ast.Pass()]
 
         return node
 
@@ -65,6 +65,10 @@ class TypeHintRemover(ast.NodeTransformer):
         for i in reversed(to_pop):
             node.body.pop(i)
 
+        # body of a class can't be empty, e.g. exceptions with only a docstring
+        if not node.body:
+            node.body.append(ast.Pass())
+
         decorators = [
             decorator.id
             for decorator in node.decorator_list
@@ -117,6 +121,21 @@ class TypeHintRemover(ast.NodeTransformer):
 
         node.body.insert(0, init)
 
+        # dataclasses compare by value, e.g. moves from the transposition table
+        names = [
+            var.target.id for var in class_vars if isinstance(var.target, ast.Name)
+        ]
+        fields = "".join(f"self.{name}, " for name in names)
+        other_fields = "".join(f"other.{name}, " for name in names)
+        eq = ast.parse(
+            "def __eq__(self, other):\n"
+            "    if other.__class__ is not self.__class__:\n"
+            "        return NotImplemented\n"
+            f"    return ({fields}) == ({other_fields})\n",
+        ).body[0]
+
+        node.body.insert(1, eq)
+
     # remove all type annotations from assignments
     def visit_AnnAssign(self, node: ast.AnnAssign) -> ast.AST | None:
         return None if node.value is None else ast.Assign([node.target], node.value)
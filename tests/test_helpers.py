@@ -2,7 +2,21 @@ from textwrap import dedent
 
 from common import big_figures, board_size, small_figures
 
-from player import Player, parse_board, Piece
+from player import (
+    DIRECTIONS,
+    PIECES,
+    SYMMETRIES,
+    BoardTables,
+    Cell,
+    Move,
+    OpeningBook,
+    Piece,
+    PieceKind,
+    Player,
+    apply_symmetry,
+    convert_board,
+    parse_board,
+)
 
 
 def test_can_move_to() -> None:
@@ -27,6 +41,64 @@ def test_can_move_to() -> None:
     assert p.can_move_to((2, 4), (1, 5))
 
 
+def test_placements_with_buried_queen() -> None:
+    p = Player("player", False, board_size, small_figures, big_figures)
+
+    p[3, 6] = [Piece.from_str("q"), Piece.from_str("B")]
+    p[4, 6] = [Piece.from_str("Q")]
+
+    # the only lower piece is under the beetle, so every cell touches the rival
+    assert list(p.placements(upper=False)) == []
+    assert set(p.placements(upper=True)) == set(p.cells_around_hive)
+
+
+def test_board_tables() -> None:
+    p = Player("player", True, board_size, small_figures, big_figures)
+    tables = BoardTables.for_size(board_size)
+
+    assert tables is p.tables
+    assert tables.cells == list(p.cells)
+
+    def on_board(p: int, q: int) -> bool:
+        return 0 <= q < board_size and 0 <= p + q // 2 < board_size
+
+    for index, cell in enumerate(tables.cells):
+        assert tables.cell_index[cell] == index
+
+        neighbors = [(cell[0] + dp, cell[1] + dq) for dp, dq in DIRECTIONS]
+        slots = tables.neighbor_indices[6 * index : 6 * index + 6]
+
+        for neighbor, slot in zip(neighbors, slots):
+            assert slot == (tables.cell_index[neighbor] if on_board(*neighbor) else -1)
+
+        assert tables.neighbor_cells[cell] == tuple(
+            neighbor for neighbor in neighbors if on_board(*neighbor)
+        )
+
+        for other in tables.cells:
+            assert tables.distance(cell, other) == p.distance(*cell, *other)
+
+
+def test_pieces_are_interned() -> None:
+    p = Player("player", True, board_size, big_figures, small_figures)
+    board = convert_board({0: {0: "qB", 1: "a"}, 1: {0: "", 1: "Q"}})
+
+    assert board[0, 0][0] is PIECES[PieceKind.Queen][False]
+    assert board[0, 0][1] is PIECES[PieceKind.Beetle][True]
+    assert board[1, 1][0] is Piece.from_str("Q")
+    assert Piece(PieceKind.Ant, False) == board[0, 1][0]
+    assert len({piece.index for pair in PIECES.values() for piece in pair}) == 10
+
+    p[2, 2] = [Piece.from_str("q")]
+    move = Move(PieceKind.Beetle, None, (2, 3))
+
+    p.play_move(move, upper=True)
+    assert p[2, 3][0] is PIECES[PieceKind.Beetle][True]
+
+    p.reverse_move(move, upper=True)
+    assert p.myPieces["B"] == 2
+
+
 def test_str() -> None:
     p = Player("player", True, board_size, small_figures, big_figures)
     print(p)
@@ -60,30 +132,32 @@ def test_parse() -> None:
     assert len(list(p.empty_cells)) == 13**2
 
 
-def test_detect_cycle() -> None:
+def test_pinned_pieces() -> None:
     p = Player("player", True, board_size, small_figures, big_figures)
 
-    p.board = parse_board(
-        dedent(
-            """
-            . . . . . . . . . . . . .
-             . . . . . . . . . . . . .
-            . . . . . . . . . . . . .
-             . . . . . . . . . . . . .
-            . . . . . . s . . . . . .
-             . . . . . . g q . . . . .
-            . . . . . . s .  . . . .
-             . . . . . q a a b . . . .
-            . . . . . . . . b . . . .
-             . . . . . . . . . . . . .
-            . . . . . . . . . . . . .
-             . . . . . . . . . . . . .
-            . . . . . . . . . . . . .
-            """,
-        ).strip()
+    p.set_board(
+        parse_board(
+            dedent(
+                """
+                . . . . . . . . . . . . .
+                 . . . . . . . . . . . . .
+                . . . . . . . . . . . . .
+                 . . . . . . . . . . . . .
+                . . . . . . s . . . . . .
+                 . . . . . . g q . . . . .
+                . . . . . . s .  . . . .
+                 . . . . . q a a b . . . .
+                . . . . . . . . b . . . .
+                 . . . . . . . . . . . . .
+                . . . . . . . . . . . . .
+                 . . . . . . . . . . . . .
+                . . . . . . . . . . . . .
+                """,
+            ).strip()
+        )
     )
 
-    assert not p.cycles
+    assert p.pinned == {(3, 6), (3, 7), (4, 5), (4, 7)}
 
     p.set_board(
         parse_board(
@@ -107,7 +181,7 @@ def test_detect_cycle() -> None:
         )
     )
 
-    assert p.cycles == {(3, 5), (3, 6), (4, 4), (4, 6), (5, 4), (5, 5)}
+    assert p.pinned == {(4, 4)}
 
     p.set_board(
         parse_board(
@@ -131,20 +205,7 @@ def test_detect_cycle() -> None:
         )
     )
 
-    assert p.cycles == {
-        (3, 5),
-        (3, 6),
-        (4, 4),
-        (4, 6),
-        (5, 4),
-        (5, 5),
-        (2, 8),
-        (2, 9),
-        (3, 7),
-        (3, 9),
-        (4, 7),
-        (4, 8),
-    }
+    assert p.pinned == {(3, 5)}
 
     p.set_board(
         parse_board(
@@ -168,19 +229,38 @@ def test_detect_cycle() -> None:
         )
     )
 
-    assert p.cycles == {
-        (4, 4),
-        (5, 5),
-        (5, 4),
-        (4, 6),
-        (3, 6),
-        (3, 5),
-        (7, 4),
-        (6, 4),
-        (5, 6),
-        (6, 6),
-        (7, 5),
-    }
-
-
-test_detect_cycle()
+    assert p.pinned == {(3, 5)}
+
+
+test_pinned_pieces()
+
+
+def test_opening_book_symmetries() -> None:
+    p = Player("player", True, board_size, big_figures, small_figures)
+    p[5, 5] = [Piece.from_str("q")]
+    p[6, 5] = [Piece.from_str("Q")]
+    p[5, 6] = [Piece.from_str("s")]
+
+    move = Move(PieceKind.Ant, None, (7, 4))
+
+    book = OpeningBook()
+    book.add(p, move, 3)
+
+    # the same position rotated, reflected and shifted on the board
+    symmetry = SYMMETRIES[5]
+    rotated = Player("player", True, board_size, big_figures, small_figures)
+
+    center_p, center_q = apply_symmetry(symmetry, (5, 5))
+
+    def transform(cell: Cell) -> Cell:
+        mapped_p, mapped_q = apply_symmetry(symmetry, cell)
+        return mapped_p - center_p + 4, mapped_q - center_q + 7
+
+    for cell, pieces in p._board.items():
+        rotated[transform(cell)] = pieces
+
+    assert book.lookup(rotated) == Move(PieceKind.Ant, None, transform((7, 4)))
+    assert book.lookup(p) == move
+
+    rotated.rivalPieces["s"] -= 1
+    assert book.lookup(rotated) is None
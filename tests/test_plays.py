@@ -1,6 +1,8 @@
+from __future__ import annotations
+
 from common import big_figures, board_size, small_figures
 
-from player import Move, Piece, PieceKind, Player, play_move
+from player import Cell, Move, Piece, PieceKind, Player, play_move
 
 
 def test_with_play_move() -> None:
@@ -39,3 +41,182 @@ def test_with_play_move() -> None:
         assert board[start] == [Piece.from_str("q")]
 
     assert all(p.is_empty(cell) for cell in p.cells)
+
+
+def test_zobrist_is_incremental() -> None:
+    p = Player("player", False, board_size, small_figures, big_figures)
+    board = p._board
+    empty = p.zobrist
+
+    start = (2, 2)
+    end = (3, 3)
+
+    with play_move(p, Move(PieceKind.Queen, None, start)):
+        placed = p.zobrist
+        assert placed != empty
+
+        with play_move(p, Move(PieceKind.Beetle, None, end)):
+            with play_move(p, Move(PieceKind.Beetle, end, start)):
+                on_top = p.zobrist
+
+                stacks = 0
+                for cell, pieces in board.items():
+                    stacks ^= p.stack_key(cell, pieces)
+
+                # three moves were played, so the other side is to move
+                assert stacks ^ p.keys.side == on_top
+
+        assert p.zobrist == placed
+
+    assert p.zobrist == empty
+
+
+def test_bitboards_are_incremental() -> None:
+    p = Player("player", False, board_size, small_figures, big_figures)
+    layout = p.layout
+
+    start = (2, 2)
+    end = (3, 2)
+
+    with play_move(p, Move(PieceKind.Queen, None, start)):
+        with play_move(p, Move(PieceKind.Beetle, None, end), upper=True):
+            with play_move(p, Move(PieceKind.Beetle, end, start), upper=True):
+                assert set(layout.cells(p.occupancy)) == {start}
+                assert set(layout.cells(p.colors[True])) == {start}
+                assert p.colors[False] == 0
+                assert set(layout.cells(p.kinds[PieceKind.Queen])) == {start}
+                assert p.queens == [(start, False)]
+                assert set(p.neighbors(end)) == {start}
+
+            assert set(layout.cells(p.colors[False])) == {start}
+            assert p.neighbor_groups(start) == 1
+            assert (3, 3) in p.cells_around_hive
+            assert end not in set(p.placements(upper=False))
+
+    assert p.occupancy == 0
+    assert p.kinds[PieceKind.Beetle] == 0
+
+
+def assert_index_matches_board(p: Player) -> None:
+    fresh = Player("fresh", p.upper, board_size, small_figures, big_figures)
+
+    for (q, r), pieces in p._board.items():
+        fresh.board[q][r] = "".join(map(str, pieces))
+
+    fresh.load_board()
+
+    assert p.queen_cells == fresh.queen_cells
+    assert p.placed == fresh.placed
+    assert p.occupancy == fresh.occupancy
+    assert p.colors == fresh.colors
+    assert p.kinds == fresh.kinds
+    assert sorted(p.queens) == sorted(fresh.queens)
+
+
+def test_location_index_is_incremental() -> None:
+    p = Player("player", False, board_size, small_figures, big_figures)
+
+    moves = [
+        (Move(PieceKind.Queen, None, (2, 2)), False),
+        (Move(PieceKind.Queen, None, (3, 2)), True),
+        (Move(PieceKind.Beetle, None, (2, 3)), False),
+        (Move(PieceKind.Beetle, None, (4, 2)), True),
+        # beetles on top of both queens, then a stack of three
+        (Move(PieceKind.Beetle, (4, 2), (3, 2)), True),
+        (Move(PieceKind.Beetle, (2, 3), (2, 2)), False),
+        (Move(PieceKind.Beetle, (3, 2), (2, 2)), True),
+        # the uncovered queen moves
+        (Move(PieceKind.Queen, (3, 2), (3, 3)), True),
+    ]
+
+    for move, upper in moves:
+        p.play_move(move, upper)
+        assert_index_matches_board(p)
+
+    assert p.queen_cells == [(2, 2), (3, 3)]
+    assert len(p[2, 2]) == 3
+
+    for move, upper in reversed(moves):
+        p.reverse_move(move, upper)
+        assert_index_matches_board(p)
+
+    assert p.queen_cells == [None, None]
+    assert not any(p.placed)
+
+
+def splits_hive(p: Player, cell: Cell) -> bool:
+    rest = set(p._board) - {cell}
+    start = next(iter(rest))
+    reached = {start}
+    stack = [start]
+
+    while stack:
+        for neighbor in p.neighbors(stack.pop()):
+            if neighbor in rest and neighbor not in reached:
+                reached.add(neighbor)
+                stack.append(neighbor)
+
+    return reached != rest
+
+
+def move_set(p: Player, upper: bool) -> set[tuple[PieceKind, Cell | None, Cell]]:
+    return {(move.piece, move.start, move.end) for move in p.moves_of(upper)}
+
+
+def test_moves_dont_depend_on_board_order() -> None:
+    p = Player("player", False, board_size, small_figures, big_figures)
+    p.rng.seed(22)
+    p.play_move(Move(PieceKind.Queen, None, (6, 6)), upper=False)
+    p.play_move(Move(PieceKind.Queen, None, (7, 6)), upper=True)
+
+    for ply in range(60):
+        upper = ply % 2 == 1
+
+        for cell, pieces in p._board.items():
+            expected = len(pieces) == 1 and splits_hive(p, cell)
+            assert p.moving_breaks_hive(cell) == expected
+
+        # the same position with the cells iterated in the reverse order
+        fresh = Player("fresh", False, board_size, small_figures, big_figures)
+
+        for (q, r), pieces in p._board.items():
+            fresh.board[q][r] = "".join(map(str, pieces))
+
+        fresh.load_board()
+        fresh._board = dict(reversed(fresh._board.items()))
+        fresh.myPieces = dict(p.myPieces)
+        fresh.rivalPieces = dict(p.rivalPieces)
+        fresh.myMove = p.myMove
+        fresh.rival_move = p.rival_move
+
+        for side in (False, True):
+            assert move_set(fresh, side) == move_set(p, side)
+
+        moves = list(p.moves_of(upper))
+
+        if not moves:
+            break
+
+        p.play_move(p.rng.choice(moves), upper)
+
+
+def test_play_move_for_rival() -> None:
+    p = Player("player", False, board_size, small_figures, big_figures)
+    board = p._board
+
+    with play_move(p, Move(PieceKind.Queen, None, (2, 2)), upper=False):
+        assert p.myPieces["q"] == 0
+
+        with play_move(p, Move(PieceKind.Queen, None, (3, 2)), upper=True):
+            assert board[3, 2] == [Piece.from_str("Q")]
+            assert p.rivalPieces["Q"] == 0
+            assert p.myPieces["q"] == 0
+
+            rival_moves = list(p.moves_of(upper=True))
+
+            assert rival_moves
+            assert all(move.start in {None, (3, 2)} for move in rival_moves)
+
+        assert p.rivalPieces["Q"] == 1
+
+    assert p.myPieces["q"] == 1
@@ -0,0 +1,561 @@
+from __future__ import annotations
+
+import math
+import signal
+import time
+
+import pytest
+from common import big_figures, board_size, small_figures
+
+from player import (
+    DEPTH_ITERATIONS,
+    MOVE_BUDGET,
+    SELECTIVITY_PRESETS,
+    Bound,
+    Cell,
+    Engine,
+    MonteCarlo,
+    Move,
+    Piece,
+    PieceKind,
+    Player,
+    Search,
+    SearchTimeout,
+    SharedTranspositionTable,
+    State,
+    ThreatSolver,
+    TimeManager,
+    play_move,
+    watchdog,
+)
+
+
+def surrounded_queen_position() -> Player:
+    p = Player("player", True, board_size, big_figures, small_figures)
+
+    p[5, 5] = [Piece.from_str("q")]
+    p[6, 5] = [Piece.from_str("Q")]
+    p[5, 6] = [Piece.from_str("b")]
+    p[4, 6] = [Piece.from_str("s")]
+    p[4, 5] = [Piece.from_str("G")]
+    p[5, 4] = [Piece.from_str("g")]
+    p[7, 5] = [Piece.from_str("A")]
+
+    p.myMove = 6
+    p.myPieces = {piece: 0 for piece in p.myPieces}
+
+    return p
+
+
+def sync_brute_board(p: Player) -> None:
+    for (q, r), pieces in p._board.items():
+        p.board[q][r] = "".join(map(str, pieces))
+
+
+def test_minimax_finds_win() -> None:
+    p = surrounded_queen_position()
+
+    moves = list(p.valid_moves)
+    result, _ = p.minimax(moves, time.perf_counter() + 5)
+
+    assert result.move.start == (7, 5)
+    assert result.move.end == (6, 4)
+    assert result.state == State.WIN
+
+
+def test_search_restores_board() -> None:
+    p = surrounded_queen_position()
+    board = {cell: pieces.copy() for cell, pieces in p._board.items()}
+
+    search = Search(p, time.perf_counter() + 5)
+    search.root(list(p.valid_moves), 3)
+
+    assert search.best_state == State.WIN
+    assert p._board == board
+
+
+def test_reduced_search_restores_board() -> None:
+    p = surrounded_queen_position()
+    p.remove_piece_from_board((7, 5))
+    p.myPieces["A"] = 2
+
+    board = {cell: pieces.copy() for cell, pieces in p._board.items()}
+    key = p.zobrist
+
+    search = Search(p, time.perf_counter() + 5)
+    search.root(list(p.valid_moves), 5)
+
+    assert search.reductions > 0
+    assert p._board == board
+    assert p.zobrist == key
+
+
+def test_repeated_position_is_draw() -> None:
+    p = surrounded_queen_position()
+    win = Move(PieceKind.Ant, (7, 5), (6, 4))
+
+    with play_move(p, win):
+        p.game_positions.add(p.zobrist)
+
+    search = Search(p, time.perf_counter() + 5)
+    search.root([win], 1)
+
+    assert search.best_state == State.DRAW
+    assert search.repetitions == 1
+
+
+def test_selectivity_presets() -> None:
+    default = SELECTIVITY_PRESETS["default"]
+    assert [default.root_width(depth) for depth in (3, 4, 6, 7)] == [None, 5, 5, 2]
+
+    for name in ("full-width", "beam"):
+        p = surrounded_queen_position()
+        p.remove_piece_from_board((7, 5))
+        p.myPieces["S"] = 1
+        p.selectivity = SELECTIVITY_PRESETS[name]
+
+        search = Search(p, time.perf_counter() + 5)
+        search.root(list(p.valid_moves), 4)
+
+        cuts = search.reductions + search.null_cutoffs
+        assert (cuts == 0) == (name == "full-width")
+
+
+def test_move_ordering() -> None:
+    p = surrounded_queen_position()
+    search = Search(p, time.perf_counter() + 5)
+
+    moves = list(p.valid_moves)
+    table_move, killer, history = moves[-1], moves[-2], moves[-3]
+
+    search.store_cutoff(killer, 1, 3, first=True)
+    search.history[history.piece, history.end] = 100
+
+    ordered = search.order_moves(moves, 3, table_move)
+
+    assert ordered[:3] == [table_move, killer, history]
+
+
+def test_aspiration_window_is_widened() -> None:
+    p = surrounded_queen_position()
+    search = Search(p, time.perf_counter() + 5)
+
+    # the expected score is far from the winning one
+    search.aspiration(list(p.valid_moves), 3, 0)
+
+    assert search.best_state == State.WIN
+    assert search.researches > 0
+
+
+def test_tactical_moves() -> None:
+    p = surrounded_queen_position()
+    search = Search(p, time.perf_counter() + 5)
+    queens = [cell for cell, _ in p.queens]
+
+    moves = list(p.valid_moves)
+    tactical = {move.end for move in moves if search.is_tactical(move, queens)}
+    quiet = {move.end for move in moves} - tactical
+
+    # surrounds the rival queen
+    assert (6, 4) in tactical
+    # leaves my queen
+    assert (5, 3) in tactical
+    # stays next to my queen
+    assert quiet == {(7, 4), (6, 6)}
+
+
+def test_beetle_leaving_queen_is_tactical() -> None:
+    p = Player("player", True, board_size, big_figures, small_figures)
+
+    p[5, 5] = [Piece.from_str("Q")]
+    p[6, 5] = [Piece.from_str("B")]
+    p[7, 5] = [Piece.from_str("a")]
+    p[8, 5] = [Piece.from_str("B")]
+
+    search = Search(p, time.perf_counter() + 5)
+    queens = [cell for cell, _ in p.queens]
+
+    # climbs on top of the ant, freeing a neighbor of the queen
+    assert search.is_tactical(Move(PieceKind.Beetle, (6, 5), (7, 5)), queens)
+    # climbs on top of the ant far from the queen
+    assert not search.is_tactical(Move(PieceKind.Beetle, (8, 5), (7, 5)), queens)
+
+
+def test_time_manager() -> None:
+    clock = TimeManager(time.perf_counter() + 10)
+    move = Move(PieceKind.Ant, None, (0, 0))
+
+    assert clock.should_continue()
+
+    clock.record(0.1, 10, move)
+    assert abs(clock.predicted_time(10) - 0.4) < 1e-9
+
+    # iterations grow six times per move
+    clock.record(0.3, 5, move)
+    assert abs(clock.predicted_time(1) - 0.36) < 1e-9
+
+    clock.end = time.perf_counter() + 0.2
+    assert not clock.should_continue()
+    assert clock.reason == "predicted timeout"
+
+    clock.end = time.perf_counter() + 10
+    clock.start -= 20
+    clock.record(0.3, 5, move)
+    assert clock.should_continue()
+
+    clock.record(0.3, 5, move)
+    assert not clock.should_continue()
+    assert clock.reason == "stable best move"
+
+
+def test_multi_pv() -> None:
+    p = surrounded_queen_position()
+    p.remove_piece_from_board((7, 5))
+    p.myPieces["S"] = 1
+
+    results = p.analyse(time.perf_counter() + 0.5, 3)
+
+    assert len(results) == 3
+    assert len({str(result.move) for result in results}) == 3
+    assert [result.score for result in results] == sorted(
+        (result.score for result in results), reverse=True
+    )
+
+    for result in results:
+        assert result.line[0] == result.move
+        assert result.depth == results[0].depth > 0
+
+
+def test_node_limit_is_deterministic() -> None:
+    moves = []
+
+    for _ in range(2):
+        p = surrounded_queen_position()
+        p.remove_piece_from_board((7, 5))
+        p.myPieces["S"] = 1
+        sync_brute_board(p)
+
+        p.tournament = True
+        p.node_limit = 2000
+        p.rng.seed(1)
+
+        moves.append(p.move())
+
+    assert moves[0] == moves[1]
+
+
+def test_search_resumes_from_table(monkeypatch: pytest.MonkeyPatch) -> None:
+    p = surrounded_queen_position()
+    p.remove_piece_from_board((7, 5))
+    p.myPieces["S"] = 1
+    p.depth_limit = 3
+
+    depths: list[int] = []
+    aspiration = Search.aspiration
+
+    def recorded(
+        search: Search, moves: list[Move], depth: int, expected: int | None
+    ) -> None:
+        depths.append(depth)
+        aspiration(search, moves, depth, expected)
+
+    monkeypatch.setattr(Search, "aspiration", recorded)
+
+    moves = list(p.valid_moves)
+    first, _ = p.minimax(moves, math.inf)
+
+    assert depths == [1, 2, 3]
+
+    depths.clear()
+    second, _ = p.minimax(moves, math.inf)
+
+    # only the quick first iteration, then right at the stored depth
+    assert depths == [1, 3]
+    assert str(second.move) == str(first.move)
+    assert second.depth == 3
+
+    def timeout(
+        search: Search, moves: list[Move], depth: int, expected: int | None
+    ) -> None:
+        if depth > 1:
+            raise SearchTimeout
+        aspiration(search, moves, depth, expected)
+
+    monkeypatch.setattr(Search, "aspiration", timeout)
+    third, _ = p.minimax(moves, math.inf)
+
+    assert third.depth == 1
+    assert third.move in moves
+
+
+def test_search_is_interruptible() -> None:
+    p = surrounded_queen_position()
+    p.remove_piece_from_board((7, 5))
+    p.myPieces["S"] = 1
+
+    with p.time_limit(time.perf_counter() - 1), pytest.raises(SearchTimeout):
+        list(p.valid_moves)
+
+    moves = list(p.valid_moves)
+
+    # unwinding a move cut in half may fail on its own, like in `Player.move`
+    with pytest.raises(Exception), watchdog(time.perf_counter() + 0.05) as fired:  # noqa: B017
+        p.minimax(moves, time.perf_counter() + 60)
+
+    assert fired[0]
+
+
+def test_watchdog_keeps_outer_timer() -> None:
+    previous = signal.signal(signal.SIGALRM, lambda _signum, _frame: None)
+
+    try:
+        signal.setitimer(signal.ITIMER_REAL, 10, 5)
+
+        with watchdog(time.perf_counter() + 5):
+            pass
+
+        delay, interval = signal.getitimer(signal.ITIMER_REAL)
+
+        assert 9 < delay <= 10
+        assert interval == 5
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def test_watchdog_returns_fallback_in_time() -> None:
+    p = surrounded_queen_position()
+    p.remove_piece_from_board((7, 5))
+    p.myPieces["S"] = 1
+    sync_brute_board(p)
+
+    # the search would run past the budget, so only the watchdog can stop it
+    p.tournament = True
+    p.time_margin = -60
+
+    start = time.perf_counter()
+    move = p.move()
+    elapsed = time.perf_counter() - start
+
+    assert elapsed < MOVE_BUDGET
+    assert p.watchdog_timeouts == 1
+    assert p.interrupted
+    assert p.fallback is not None
+    assert move == p.fallback.to_brute(p.upper)
+
+    p.time_margin = 0.5
+    p.move()
+
+    assert not p.interrupted
+
+
+def test_watchdog_restores_reserves(monkeypatch: pytest.MonkeyPatch) -> None:
+    p = surrounded_queen_position()
+    p.remove_piece_from_board((7, 5))
+    p.myPieces["S"] = 1
+    sync_brute_board(p)
+
+    p.tournament = True
+    p.time_margin = -60
+
+    my_pieces = p.myPieces.copy()
+    rival_pieces = p.rivalPieces.copy()
+    my_move = p.myMove
+    add_piece = Player.add_piece_to_board
+
+    def stalled(player: Player, cell: Cell, piece: Piece) -> None:
+        # wait for the watchdog after the piece left the reserve, but isn't placed
+        if player.myPieces != my_pieces:
+            time.sleep(5)
+
+        add_piece(player, cell, piece)
+
+    monkeypatch.setattr(Player, "add_piece_to_board", stalled)
+    p.move()
+
+    assert p.watchdog_timeouts == 1
+    assert p.myPieces == my_pieces
+    assert p.rivalPieces == rival_pieces
+    assert p.myMove == my_move
+
+
+def test_threat_solver() -> None:
+    p = surrounded_queen_position()
+    board = {cell: pieces.copy() for cell, pieces in p._board.items()}
+
+    solver = ThreatSolver(p, time.perf_counter() + 5)
+    move = solver.solve(3)
+
+    assert move is not None
+    assert move.start == (7, 5)
+    assert move.end == (6, 4)
+    assert p._board == board
+
+    # without the ant, only my queen reaches the last free cell, freeing another
+    p.remove_piece_from_board((7, 5))
+    board = {cell: pieces.copy() for cell, pieces in p._board.items()}
+
+    assert ThreatSolver(p, time.perf_counter() + 5).solve(3) is None
+    assert p._board == board
+
+
+def test_monte_carlo_finds_win() -> None:
+    p = surrounded_queen_position()
+    board = {cell: pieces.copy() for cell, pieces in p._board.items()}
+
+    monte_carlo = MonteCarlo(p, time.perf_counter() + 0.5)
+    best = monte_carlo.run(list(p.valid_moves))
+
+    assert best.end == (6, 4)
+    assert p._board == board
+
+
+def test_monte_carlo_tree_is_capped() -> None:
+    p = surrounded_queen_position()
+    p.tree_nodes = 100
+
+    for _ in range(2):
+        monte_carlo = MonteCarlo(p, time.perf_counter() + 0.2)
+        best = monte_carlo.run(list(p.valid_moves))
+
+        assert best.end == (6, 4)
+        assert monte_carlo.tree is p.tree
+        assert monte_carlo.tree.size <= 100
+        assert monte_carlo.full_tree > 0
+
+
+def test_monte_carlo_depth_limit() -> None:
+    moves = []
+
+    for _ in range(2):
+        p = surrounded_queen_position()
+        p.remove_piece_from_board((7, 5))
+        p.myPieces["S"] = 1
+        sync_brute_board(p)
+
+        p.tournament = True
+        p.engine = Engine.MONTE_CARLO
+        p.depth_limit = 2
+        p.rng.seed(1)
+
+        moves.append(p.move())
+
+    assert moves[0]
+    assert moves[0] == moves[1]
+
+    monte_carlo = MonteCarlo(p, math.inf)
+    monte_carlo.run(list(p.valid_moves))
+
+    assert monte_carlo.iterations == 2 * DEPTH_ITERATIONS
+
+
+def test_parallel_minimax_finds_win() -> None:
+    p = surrounded_queen_position()
+    sync_brute_board(p)
+
+    p.start_workers(2)
+
+    try:
+        result = p.parallel_minimax(list(p.valid_moves), time.perf_counter() + 2)
+    finally:
+        p.stop_workers()
+
+    assert result.move.start == (7, 5)
+    assert result.move.end == (6, 4)
+    assert result.state == State.WIN
+
+
+def test_pondering_fills_table() -> None:
+    p = surrounded_queen_position()
+    sync_brute_board(p)
+
+    p.start_workers(1, ponder=True)
+
+    try:
+        move = Move(PieceKind.Ant, (7, 5), (7, 4))
+        p.start_pondering(move, p.pondering_replies(move))
+        time.sleep(0.3)
+        result = p.stop_pondering()
+        stored = len(p.table)
+    finally:
+        p.stop_workers()
+
+    assert result is not None
+    assert result.depth > 0
+    assert stored > 0
+
+
+def test_stopping_pondering_is_bounded() -> None:
+    p = surrounded_queen_position()
+    p.start_workers(1, ponder=True)
+
+    try:
+        # a worker that ignores the stop flag
+        assert p.pool is not None
+        p.pondering = p.pool.apply_async(time.sleep, (5,))
+
+        start = time.perf_counter()
+        result = p.stop_pondering()
+        elapsed = time.perf_counter() - start
+
+        assert result is None
+        assert elapsed < 1
+        assert p.pool is not None
+        assert p.pool.apply(abs, (-1,)) == 1
+    finally:
+        p.stop_workers()
+
+
+def test_pondering_starts_after_the_time_limit() -> None:
+    p = surrounded_queen_position()
+    p.remove_piece_from_board((7, 5))
+    p.myPieces["S"] = 1
+    sync_brute_board(p)
+
+    p.rivalPieces["q"] = 0
+    p.tournament = True
+    p.start_workers(1, ponder=True)
+
+    try:
+        # the search returns past its deadline, while the replies still get generated
+        p.time_margin = MOVE_BUDGET
+        move = p.move()
+
+        assert move
+        assert p.pondering is not None
+    finally:
+        p.stop_workers()
+
+
+def test_shared_table_packs_entries() -> None:
+    table = SharedTranspositionTable(board_size, 16)
+    move = Move(PieceKind.Ant, (7, 5), (6, 4))
+    placement = Move(PieceKind.Queen, None, (0, 12))
+
+    table.store(0x1234, 5, -1000000, State.LOSS, Bound.UPPER, move)
+    table.store(0x1235, 64, 42, State.RUNNING, Bound.EXACT, placement)
+    table.store(0x1236, 0, 7, State.RUNNING, Bound.LOWER, None)
+
+    entry = table.probe(0x1234)
+    assert entry is not None
+    assert (entry.depth, entry.score, entry.state, entry.bound, entry.move) == (
+        5,
+        -1000000,
+        State.LOSS,
+        Bound.UPPER,
+        move,
+    )
+
+    entry = table.probe(0x1235)
+    assert entry is not None
+    assert (entry.depth, entry.score, entry.move) == (64, 42, placement)
+
+    entry = table.probe(0x1236)
+    assert entry is not None
+    assert entry.move is None
+
+    assert table.probe(0x1234 + 16) is None
+    assert len(table) == 3
+
+    table.clear()
+    assert table.probe(0x1234) is None